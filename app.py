@@ -4,21 +4,54 @@ APLICACIÓN GPS SIMPLIFICADA
 Muestra el último estado GPS actualizado automáticamente
 """
 
-from flask import Flask, jsonify, render_template_string
+from flask import Flask, Response, jsonify, request, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
+import orjson
+import gzip
 import os
+import atexit
+import logging
 import time
 import threading
+try:
+    import fcntl  # Solo disponible en sistemas POSIX (Linux/Render)
+except ImportError:
+    fcntl = None
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
 from datetime import datetime, UTC, timedelta
 from main import TrackSolidAPI
 
+class OrjsonProvider(DefaultJSONProvider):
+    """Proveedor JSON de Flask basado en orjson (serializa varias veces más rápido)"""
+    
+    option = orjson.OPT_NON_STR_KEYS
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=self.option).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, default=self.default, option=self.option),
+            mimetype=self.mimetype
+        )
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 CORS(app)
 
 # Cargar variables de entorno desde .env
 from dotenv import load_dotenv
 load_dotenv()
 
+# Nivel de log configurable (DEBUG muestra el detalle por dispositivo)
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), format="%(message)s")
+logger = logging.getLogger(__name__)
+
 # Configuración desde variables de entorno
 CONFIG = {
     "APP_KEY": os.getenv("TRACKSOLID_APP_KEY"),
@@ -41,11 +74,37 @@ if not all([CONFIG["APP_KEY"], CONFIG["APP_SECRET"], CONFIG["USER_EMAIL"], CONFI
 # Variables globales
 api_gps = None
 ubicaciones_actuales = []
+dispositivos_resumen = []  # [{deviceName, imei, status}] de ubicaciones_actuales, para /api/diagnostico
 historial_rutas = {}  # Diccionario para almacenar historial: {imei: [coords]}
 MAX_PUNTOS_HISTORIAL = 5000  # Mantener últimos 5000 puntos (aprox 41 horas a 30s)
+PRECISION_COORDENADAS = 6  # Decimales de lat/lng (~10 cm, más de lo que da un GPS)
+MAX_HILOS_UBICACIONES = 32  # Consultas de ubicación simultáneas por actualización
+TIMEOUT_UBICACIONES = 15  # Segundos máximos de espera por las ubicaciones de un ciclo
 ultima_actualizacion = None
+ultima_actualizacion_iso = None  # ultima_actualizacion ya formateada, para no repetir isoformat() por petición
 ultimo_dia_limpieza = None  # Para controlar el borrado diario
 lock_actualizacion = threading.Lock()
+evento_actualizar = threading.Event()  # Despierta el bucle para actualizar de inmediato
+evento_detener = threading.Event()  # Señala al bucle que debe terminar
+hilo_actualizacion = None  # Hilo del bucle, solo en el proceso líder
+estado_refresco = {"estado": "inactivo", "inicio": None, "fin": None, "dispositivos": 0}  # Última actualización del bucle
+RUN_POLLER = os.getenv("RUN_POLLER")  # "1" fuerza el bucle en este proceso, "0" lo desactiva
+POLLER_LOCK_FILE = os.getenv("POLLER_LOCK_FILE", "/tmp/gps_poller.lock")
+archivo_lock_poller = None  # Se mantiene abierto mientras este proceso sea el líder
+TTL_UBICACION = 10  # Segundos durante los que se reutiliza la ubicación de un IMEI (cache de TrackSolidAPI)
+# Respuesta de /api/ubicaciones ya serializada: se regenera una vez por actualización
+ubicaciones_payload = orjson.dumps({"success": True, "ubicaciones": [], "total": 0, "ultima_actualizacion": None})
+etag_actual = "0-0"  # ETag débil de las respuestas derivadas de la última actualización
+# Respuesta de /api/estado: solo cambia cuando se publica una actualización
+estado_payload = orjson.dumps({"status": "online", "dispositivos": 0, "intervalo": CONFIG["INTERVALO"], "ultima_actualizacion": None})
+version_payload = 0  # Se incrementa cada vez que se publica un ubicaciones_payload nuevo
+condicion_payload = threading.Condition()  # Avisa a los clientes de /api/stream
+KEEPALIVE_STREAM = 15  # Segundos entre comentarios de keepalive en /api/stream
+# Cada cliente de /api/stream ocupa un hilo de Gunicorn mientras la pestaña está
+# abierta: se limita por proceso para que queden hilos libres para la API JSON
+MAX_CLIENTES_STREAM = int(os.getenv("MAX_CLIENTES_STREAM", "8"))
+clientes_stream = 0
+lock_clientes_stream = threading.Lock()
 
 def inicializar_api():
     """Inicializa la API"""
@@ -79,9 +138,23 @@ def inicializar_api():
         traceback.print_exc()
         return False
 
+def obtener_ubicacion_cacheada(imei, ttl=TTL_UBICACION):
+    """
+    Atajo a TrackSolidAPI.obtener_ubicacion con el TTL de la app
+    
+    El cache por IMEI vive en TrackSolidAPI; aquí solo se fija cuánto tiempo
+    (`ttl` segundos) se acepta reutilizar la última ubicación consultada.
+    """
+    return api_gps.obtener_ubicacion(imei, ttl=ttl)
+
 def actualizar_ubicaciones():
-    """Actualiza las ubicaciones de todos los dispositivos"""
-    global ubicaciones_actuales, ultima_actualizacion, historial_rutas, ultimo_dia_limpieza
+    """
+    Actualiza las ubicaciones de todos los dispositivos
+    
+    Returns:
+        True si se publicaron ubicaciones nuevas, False si hubo error
+    """
+    global ubicaciones_actuales, ultima_actualizacion, ultima_actualizacion_iso, historial_rutas, ultimo_dia_limpieza, ubicaciones_payload, geojson_cache, version_payload, dispositivos_resumen, estado_payload, etag_actual
     
     # --- Lógica de Limpieza Diaria (00:00 UTC-5) ---
     try:
@@ -94,37 +167,50 @@ def actualizar_ubicaciones():
             ultimo_dia_limpieza = dia_actual
         elif dia_actual != ultimo_dia_limpieza:
             # Cambio de día detectado -> Limpiar historial
-            print(f"\n🧹 [AUTO-LIMPIEZA] Cambio de día detectado ({ultimo_dia_limpieza} -> {dia_actual})")
-            print("   Borrando historial de rutas para iniciar nuevo día...")
+            logger.info("🧹 [AUTO-LIMPIEZA] Cambio de día detectado (%s -> %s)", ultimo_dia_limpieza, dia_actual)
+            logger.info("   Borrando historial de rutas para iniciar nuevo día...")
             historial_rutas = {}
             ultimo_dia_limpieza = dia_actual
     except Exception as e:
-        print(f"⚠️ Error en lógica de limpieza diaria: {e}")
+        logger.warning("⚠️ Error en lógica de limpieza diaria: %s", e)
     # -----------------------------------------------
 
     if not api_gps or not api_gps.access_token:
-        print("⚠️ API no inicializada o sin token")
-        return
+        logger.warning("⚠️ API no inicializada o sin token")
+        return False
     
     try:
-        print("📱 Solicitando lista de dispositivos...")
+        # TrackSolidAPI reutiliza la lista durante TTL_DISPOSITIVOS y no guarda
+        # los errores: tras un fallo, el siguiente ciclo vuelve a consultarla
         dispositivos = api_gps.listar_dispositivos()
         
         if not dispositivos:
-            print("⚠️ No se obtuvieron dispositivos de la API")
-            return
+            logger.warning("⚠️ No se obtuvieron dispositivos de la API")
+            return False
         
-        print(f"✅ Se encontraron {len(dispositivos)} dispositivos")
+        logger.debug("✅ Se encontraron %d dispositivos", len(dispositivos))
         
         nuevas_ubicaciones = []
+        # Copia superficial del historial: las rutas modificadas se sustituyen
+        # por listas nuevas y el historial publicado nunca se altera en sitio
+        nuevo_historial = dict(historial_rutas)
         
-        for disp in dispositivos:
+        # Las consultas por dispositivo son independientes: lanzarlas en paralelo
+        # para que el tiempo total sea ~max(RTT) en lugar de la suma
+        ex = ThreadPoolExecutor(max_workers=min(MAX_HILOS_UBICACIONES, len(dispositivos)))
+        futuros = [(disp, ex.submit(obtener_ubicacion_cacheada, disp.get('imei'))) for disp in dispositivos]
+        # No esperar a los hilos que sigan colgados al terminar el plazo: el
+        # timeout HTTP de TrackSolidAPI los acaba liberando por su cuenta
+        ex.shutdown(wait=False)
+        limite = time.monotonic() + TIMEOUT_UBICACIONES
+        
+        for disp, futuro in futuros:
             imei = disp.get('imei')
             nombre = disp.get('deviceName', 'Sin nombre')
-            print(f"📍 Obteniendo ubicación de {nombre} ({imei})...")
+            logger.debug("📍 Procesando ubicación de %s (%s)...", nombre, imei)
             
             try:
-                ubicacion = api_gps.obtener_ubicacion(imei)
+                ubicacion = futuro.result(timeout=max(0, limite - time.monotonic()))
                 if ubicacion:
                     ubicacion['deviceName'] = nombre
                     ubicacion['imei'] = imei
@@ -166,35 +252,214 @@ def actualizar_ubicaciones():
                     nuevas_ubicaciones.append(ubicacion)
                     
                     # Actualizar historial
-                    lat = float(ubicacion.get('lat', 0))
-                    lng = float(ubicacion.get('lng', 0))
+                    lat = round(float(ubicacion.get('lat', 0)), PRECISION_COORDENADAS)
+                    lng = round(float(ubicacion.get('lng', 0)), PRECISION_COORDENADAS)
                     
-                    if imei not in historial_rutas:
-                        historial_rutas[imei] = []
+                    ruta = nuevo_historial.get(imei, [])
                     
                     # Agregar punto si es diferente al último (evitar duplicados estáticos)
                     nuevo_punto = [lng, lat]
-                    if not historial_rutas[imei] or historial_rutas[imei][-1] != nuevo_punto:
-                        historial_rutas[imei].append(nuevo_punto)
-                        # Limitar tamaño del historial
-                        if len(historial_rutas[imei]) > MAX_PUNTOS_HISTORIAL:
-                            historial_rutas[imei] = historial_rutas[imei][-MAX_PUNTOS_HISTORIAL:]
+                    if not ruta or ruta[-1] != nuevo_punto:
+                        # Limitar tamaño del historial al copiar la ruta
+                        nuevo_historial[imei] = ruta[-(MAX_PUNTOS_HISTORIAL - 1):] + [nuevo_punto]
                             
-                    print(f"   ✅ Ubicación obtenida: {lat}, {lng}")
+                    logger.debug("   ✅ Ubicación obtenida: %s, %s", lat, lng)
                 else:
-                    print(f"   ⚠️ No se obtuvo ubicación para {nombre}")
+                    logger.warning("   ⚠️ No se obtuvo ubicación para %s", nombre)
+            except FuturesTimeoutError:
+                logger.warning("   ⏱️ Tiempo agotado obteniendo ubicación de %s (%s)", nombre, imei)
             except Exception as e:
-                print(f"   ❌ Error obteniendo ubicación {imei}: {str(e)}")
+                logger.error("   ❌ Error obteniendo ubicación %s: %s", imei, e)
         
+        # Construir todo lo que se publica en variables locales y solo al final
+        # reasignar los globales: cada reasignación es atómica en CPython, así
+        # que los handlers leen siempre una versión completa sin usar locks.
+        # Lo ya publicado no se modifica nunca en sitio.
+        nueva_fecha = datetime.now()
+        nueva_fecha_iso = nueva_fecha.isoformat()
+        nuevo_resumen = [
+            {
+                "deviceName": u.get('deviceName'),
+                "imei": u.get('imei'),
+                "status": u.get('status')
+            } for u in nuevas_ubicaciones
+        ]
+        nuevo_payload = orjson.dumps({
+            "success": True,
+            "ubicaciones": nuevas_ubicaciones,
+            "total": len(nuevas_ubicaciones),
+            "ultima_actualizacion": nueva_fecha_iso
+        })
+        nuevo_estado = orjson.dumps({
+            "status": "online",
+            "dispositivos": len(nuevas_ubicaciones),
+            "intervalo": CONFIG["INTERVALO"],
+            "ultima_actualizacion": nueva_fecha_iso
+        })
+        nuevo_geojson = construir_geojson(nuevas_ubicaciones, nuevo_historial)
+        
+        historial_rutas = nuevo_historial
         ubicaciones_actuales = nuevas_ubicaciones
-        ultima_actualizacion = datetime.now()
+        dispositivos_resumen = nuevo_resumen
+        ubicaciones_payload = nuevo_payload
+        estado_payload = nuevo_estado
+        geojson_cache = nuevo_geojson
+        etag_actual = f"{int(nueva_fecha.timestamp() * 1000)}-{len(nuevas_ubicaciones)}"
+        ultima_actualizacion = nueva_fecha
+        ultima_actualizacion_iso = nueva_fecha_iso
+        
+        # Despertar a los clientes conectados a /api/stream
+        with condicion_payload:
+            version_payload += 1
+            condicion_payload.notify_all()
         
-        print(f"📡 Actualizado: {len(nuevas_ubicaciones)} dispositivos con ubicación")
+        logger.info("📡 Actualizado: %d dispositivos con ubicación", len(nuevas_ubicaciones))
+        return True
         
     except Exception as e:
-        print(f"❌ Error actualizando: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("❌ Error actualizando: %s", e)
+        return False
+
+def ejecutar_actualizacion():
+    """Ejecuta una actualización registrando su progreso en estado_refresco"""
+    global estado_refresco
+    
+    inicio = datetime.now().isoformat()
+    estado_refresco = {"estado": "en_curso", "inicio": inicio, "fin": None, "dispositivos": len(ubicaciones_actuales)}
+    
+    exito = actualizar_ubicaciones()
+    
+    estado_refresco = {
+        "estado": "completado" if exito else "error",
+        "inicio": inicio,
+        "fin": datetime.now().isoformat(),
+        "dispositivos": len(ubicaciones_actuales)
+    }
+
+def lanzar_actualizacion():
+    """
+    Ejecuta una actualización en un hilo aparte, para procesos sin bucle propio
+    
+    Returns:
+        True si se lanzó, False si ya había una actualización en curso
+    """
+    if not lock_actualizacion.acquire(blocking=False):
+        return False
+    
+    def tarea():
+        try:
+            ejecutar_actualizacion()
+        except Exception as e:
+            logger.exception("❌ Error en actualización manual: %s", e)
+        finally:
+            lock_actualizacion.release()
+    
+    threading.Thread(target=tarea, daemon=True).start()
+    return True
+
+def construir_geojson(ubicaciones, historial):
+    """
+    Construye las variantes GeoJSON (completo, puntos, rutas y la secuencia
+    RFC 7464 del completo) ya serializadas
+    
+    Args:
+        ubicaciones: Lista de ubicaciones actuales
+        historial: Diccionario {imei: [coords]} con las rutas
+        
+    Returns:
+        Diccionario {variante: bytes}, con cada variante también comprimida
+        en gzip bajo la clave "<variante>_gz"
+    """
+    generado = datetime.now(UTC).isoformat()
+    puntos = []
+    puntos_completo = []
+    rutas = []
+    rutas_completo = []
+    
+    # 1. Puntos (Ubicación actual)
+    for ubicacion in ubicaciones:
+        geometria = {
+            "type": "Point",
+            "coordinates": [
+                round(float(ubicacion.get('lng', 0)), PRECISION_COORDENADAS),
+                round(float(ubicacion.get('lat', 0)), PRECISION_COORDENADAS)
+            ]
+        }
+        propiedades = {
+            "deviceName": ubicacion.get('deviceName', 'Sin nombre'),
+            "imei": ubicacion.get('imei'),
+            "speed": ubicacion.get('speed', 0),
+            "direction": ubicacion.get('direction', 0),
+            "accStatus": ubicacion.get('accStatus'),
+            "gpsTime": ubicacion.get('gpsTime'),
+            "status": ubicacion.get('status'),
+            "powerValue": ubicacion.get('powerValue'),
+            "vehicleState": ubicacion.get('vehicleState', 'DESCONOCIDO'),
+            "vehicleStateId": ubicacion.get('vehicleStateId', 0),
+            "fuelLevel": ubicacion.get('fuelLevel', 'N/A')
+        }
+        puntos.append({"type": "Feature", "geometry": geometria, "properties": propiedades})
+        puntos_completo.append({
+            "type": "Feature",
+            "geometry": geometria,
+            "properties": {"type": "current_location", **propiedades}
+        })
+    
+    # 2. Rutas (Tracklines)
+    # Índice por IMEI para no recorrer todas las ubicaciones en cada ruta
+    ubicaciones_por_imei = {u.get('imei'): u for u in ubicaciones}
+    for imei, coords in historial.items():
+        if len(coords) > 1:
+            # Nombre del dispositivo y datos actuales para enriquecer el trackline
+            datos_actuales = ubicaciones_por_imei.get(imei, {})
+            nombre = datos_actuales.get('deviceName', 'Sin nombre') if datos_actuales else "Desconocido"
+            
+            geometria = {
+                "type": "LineString",
+                "coordinates": coords
+            }
+            propiedades = {
+                "deviceName": nombre,
+                "imei": imei,
+                "speed": datos_actuales.get('speed', 0),
+                "gpsTime": datos_actuales.get('gpsTime', ''),
+                "direction": datos_actuales.get('direction', 0),
+                "powerValue": datos_actuales.get('powerValue', 0),
+                "vehicleState": datos_actuales.get('vehicleState', 'DESCONOCIDO'),
+                "vehicleStateId": datos_actuales.get('vehicleStateId', 0),
+                "fuelLevel": datos_actuales.get('fuelLevel', 'N/A')
+            }
+            rutas.append({"type": "Feature", "geometry": geometria, "properties": propiedades})
+            rutas_completo.append({
+                "type": "Feature",
+                "geometry": geometria,
+                "properties": {"type": "trackline", **propiedades}
+            })
+    
+    def coleccion(features, tipo):
+        return orjson.dumps({
+            "type": "FeatureCollection",
+            "features": features,
+            "metadata": {
+                "generated": generado,
+                "type": tipo
+            }
+        })
+    
+    features_completo = puntos_completo + rutas_completo
+    variantes = {
+        "completo": coleccion(features_completo, "completo"),
+        "puntos": coleccion(puntos, "puntos"),
+        "rutas": coleccion(rutas, "rutas"),
+        # GeoJSON Text Sequence: un Feature por registro, precedido de RS (0x1E)
+        "secuencia": b"".join(b"\x1e" + orjson.dumps(f) + b"\n" for f in features_completo)
+    }
+    # El GeoJSON es muy repetitivo: comprimirlo una vez por actualización y no por petición
+    variantes.update({f"{k}_gz": gzip.compress(v, compresslevel=6) for k, v in list(variantes.items())})
+    return variantes
+
+# GeoJSON ya serializados {variante: bytes}: colecciones vacías hasta la primera actualización
+geojson_cache = construir_geojson([], {})
 
 def actualizar_si_necesario():
     global ultima_actualizacion
@@ -212,15 +477,30 @@ def actualizar_si_necesario():
 
 
 def bucle_actualizacion():
-    print(f"🔄 Iniciando actualización automática cada {CONFIG['INTERVALO']} segundos")
+    logger.info("🔄 Iniciando actualización automática cada %s segundos", CONFIG['INTERVALO'])
     
-    while True:
+    # La primera actualización ya la hace inicializar_aplicacion: esperar antes de repetirla
+    while not evento_detener.is_set():
+        # Dormir el intervalo, pero despertar en cuanto se pida una actualización o la detención
+        evento_actualizar.wait(timeout=CONFIG["INTERVALO"])
+        evento_actualizar.clear()
+        if evento_detener.is_set():
+            break
+        
         try:
-            actualizar_ubicaciones()
-            time.sleep(CONFIG["INTERVALO"])
+            with lock_actualizacion:
+                ejecutar_actualizacion()
         except Exception as e:
-            print(f"❌ Error en bucle: {str(e)}")
-            time.sleep(CONFIG["INTERVALO"])
+            logger.exception("❌ Error en bucle: %s", e)
+    
+    logger.info("🛑 Actualización automática detenida")
+
+def detener_actualizacion_automatica():
+    """Detiene el bucle de actualización y descarta las ubicaciones en cache"""
+    evento_detener.set()
+    evento_actualizar.set()  # Despertar el bucle si está esperando
+    if api_gps:
+        api_gps.invalidar_ubicaciones()
 
 # Template HTML simplificado
 HTML_TEMPLATE = """
@@ -255,6 +535,12 @@ HTML_TEMPLATE = """
             font-size: 0.9rem;
             padding: 5px 10px;
         }
+        .status-badge.pulse {
+            animation: pulso 0.3s ease-out;
+        }
+        @keyframes pulso {
+            50% { transform: scale(1.15); }
+        }
         .update-time {
             font-size: 0.85rem;
             color: #6c757d;
@@ -385,38 +671,40 @@ HTML_TEMPLATE = """
             `;
         }
 
+        function mostrarUbicaciones(data) {
+            if (data.success) {
+                const container = document.getElementById('dispositivosContainer');
+                
+                if (data.ubicaciones.length === 0) {
+                    container.innerHTML = `
+                        <div class="col-12">
+                            <div class="alert alert-warning">
+                                ⚠️ No se encontraron dispositivos
+                            </div>
+                        </div>
+                    `;
+                } else {
+                    container.innerHTML = data.ubicaciones
+                        .map(disp => crearTarjetaDispositivo(disp))
+                        .join('');
+                }
+
+                // Actualizar tiempo
+                document.getElementById('ultimaActualizacion').textContent = 
+                    'Última actualización: ' + formatearFecha(data.ultima_actualizacion);
+                
+                document.getElementById('estadoConexion').textContent = 
+                    '✅ Conectado';
+            } else {
+                document.getElementById('estadoConexion').textContent = 
+                    '❌ Error';
+            }
+        }
+
         function actualizarDispositivos() {
             fetch('/api/ubicaciones')
                 .then(response => response.json())
-                .then(data => {
-                    if (data.success) {
-                        const container = document.getElementById('dispositivosContainer');
-                        
-                        if (data.ubicaciones.length === 0) {
-                            container.innerHTML = `
-                                <div class="col-12">
-                                    <div class="alert alert-warning">
-                                        ⚠️ No se encontraron dispositivos
-                                    </div>
-                                </div>
-                            `;
-                        } else {
-                            container.innerHTML = data.ubicaciones
-                                .map(disp => crearTarjetaDispositivo(disp))
-                                .join('');
-                        }
-
-                        // Actualizar tiempo
-                        document.getElementById('ultimaActualizacion').textContent = 
-                            'Última actualización: ' + formatearFecha(data.ultima_actualizacion);
-                        
-                        document.getElementById('estadoConexion').textContent = 
-                            '✅ Conectado';
-                    } else {
-                        document.getElementById('estadoConexion').textContent = 
-                            '❌ Error';
-                    }
-                })
+                .then(mostrarUbicaciones)
                 .catch(error => {
                     console.error('Error:', error);
                     document.getElementById('estadoConexion').textContent = 
@@ -424,54 +712,138 @@ HTML_TEMPLATE = """
                 });
         }
 
-        // Actualizar inmediatamente al cargar
-        actualizarDispositivos();
-
-        // Actualizar automáticamente
-        setInterval(actualizarDispositivos, intervaloActualizacion);
+        function consultarPeriodicamente() {
+            actualizarDispositivos();
+            setInterval(actualizarDispositivos, intervaloActualizacion);
+        }
 
-        // Mostrar siguiente actualización
-        setInterval(() => {
-            const badge = document.querySelector('.status-badge');
-            badge.classList.add('pulse');
-            setTimeout(() => badge.classList.remove('pulse'), 300);
-        }, intervaloActualizacion);
+        if (window.EventSource) {
+            // El servidor envía las ubicaciones solo cuando hay datos nuevos
+            const stream = new EventSource('/api/stream');
+            stream.onmessage = (evento) => {
+                mostrarUbicaciones(JSON.parse(evento.data));
+                const badge = document.querySelector('.status-badge');
+                badge.classList.add('pulse');
+                setTimeout(() => badge.classList.remove('pulse'), 300);
+            };
+            stream.onerror = () => {
+                if (stream.readyState === EventSource.CLOSED) {
+                    // El servidor rechazó el stream (límite de clientes): consultar periódicamente
+                    consultarPeriodicamente();
+                    return;
+                }
+                // EventSource reintenta la conexión por sí solo
+                document.getElementById('estadoConexion').textContent = 
+                    '⚠️ Sin conexión';
+            };
+        } else {
+            // Navegadores sin SSE
+            consultarPeriodicamente();
+        }
     </script>
 </body>
 </html>
 """
 
+# Compilar la plantilla una sola vez al importar, no en cada petición
+plantilla_principal = app.jinja_env.from_string(HTML_TEMPLATE)
+
+def respuesta_cacheable(etag, contenido, mimetype, contenido_gz=None):
+    """
+    Devuelve `contenido` con ETag débil, o 304 si el cliente ya lo tiene
+    
+    Args:
+        etag: Valor de etag_actual (leerlo antes que el contenido: en el peor
+            caso el cliente recibe datos nuevos con la etiqueta anterior)
+        contenido: Bytes ya serializados
+        mimetype: Tipo de contenido de la respuesta
+        contenido_gz: Mismo contenido ya comprimido en gzip, si existe
+        
+    Returns:
+        Response con el contenido o 304 Not Modified
+    """
+    if request.if_none_match.contains_weak(etag):
+        respuesta = Response(status=304)
+    elif contenido_gz is not None and request.accept_encodings.quality('gzip') > 0:
+        respuesta = Response(contenido_gz, mimetype=mimetype)
+        respuesta.headers["Content-Encoding"] = "gzip"
+    else:
+        respuesta = Response(contenido, mimetype=mimetype)
+    if contenido_gz is not None:
+        respuesta.vary.add("Accept-Encoding")
+    respuesta.set_etag(etag, weak=True)
+    return respuesta
+
 @app.route('/')
 def index():
     """Página principal"""
-    return render_template_string(HTML_TEMPLATE, intervalo=CONFIG["INTERVALO"])
+    return plantilla_principal.render(intervalo=CONFIG["INTERVALO"])
 
 @app.route('/api/ubicaciones')
 def api_ubicaciones():
     """API: Obtiene las ubicaciones actuales"""
     try:
         actualizar_si_necesario()
-        return jsonify({
-            "success": True,
-            "ubicaciones": ubicaciones_actuales,
-            "total": len(ubicaciones_actuales),
-            "ultima_actualizacion": ultima_actualizacion.isoformat() if ultima_actualizacion else None
-        })
+        return respuesta_cacheable(etag_actual, ubicaciones_payload, 'application/json')
     except Exception as e:
         return jsonify({
             "success": False,
             "error": str(e)
         }), 500
 
+@app.route('/api/stream')
+def api_stream():
+    """API: Envía ubicaciones_payload por Server-Sent Events cada vez que cambia"""
+    global clientes_stream
+    
+    with lock_clientes_stream:
+        if clientes_stream >= MAX_CLIENTES_STREAM:
+            # El navegador cae a consultar /api/ubicaciones periódicamente
+            return Response("Demasiados clientes en /api/stream", status=503, headers={"Retry-After": str(KEEPALIVE_STREAM)})
+        clientes_stream += 1
+    
+    def liberar():
+        global clientes_stream
+        with lock_clientes_stream:
+            clientes_stream -= 1
+    
+    def generar():
+        version = -1
+        while not evento_detener.is_set():
+            if not (hilo_actualizacion and hilo_actualizacion.is_alive()):
+                # Proceso sin bucle (worker no líder o RUN_POLLER=0): nadie más
+                # publica aquí, refrescar bajo demanda (como mucho un refresco
+                # por intervalo vencido, sin bloquear a los demás clientes)
+                actualizar_si_necesario()
+            
+            with condicion_payload:
+                if version == version_payload:
+                    condicion_payload.wait(timeout=KEEPALIVE_STREAM)
+                nueva_version = version_payload
+                payload = ubicaciones_payload
+            
+            if nueva_version == version:
+                # Sin datos nuevos: mantener viva la conexión
+                yield b": keepalive\n\n"
+                continue
+            
+            version = nueva_version
+            yield b"data: " + payload + b"\n\n"
+    
+    respuesta = Response(
+        stream_with_context(generar()),
+        mimetype='text/event-stream',
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+    # El servidor cierra la respuesta al desconectarse el cliente (se haya
+    # empezado o no a recorrer el generador)
+    respuesta.call_on_close(liberar)
+    return respuesta
+
 @app.route('/api/estado')
 def api_estado():
     """API: Estado del sistema"""
-    return jsonify({
-        "status": "online",
-        "dispositivos": len(ubicaciones_actuales),
-        "intervalo": CONFIG["INTERVALO"],
-        "ultima_actualizacion": ultima_actualizacion.isoformat() if ultima_actualizacion else None
-    })
+    return respuesta_cacheable(etag_actual, estado_payload, 'application/json')
 
 @app.route('/api/diagnostico')
 def api_diagnostico():
@@ -499,21 +871,20 @@ def api_diagnostico():
             },
             "datos": {
                 "ubicaciones_actuales": len(ubicaciones_actuales),
-                "ultima_actualizacion": ultima_actualizacion.isoformat() if ultima_actualizacion else None,
-                "dispositivos": [
-                    {
-                        "deviceName": u.get('deviceName'),
-                        "imei": u.get('imei'),
-                        "status": u.get('status')
-                    } for u in ubicaciones_actuales
-                ]
+                "ultima_actualizacion": ultima_actualizacion_iso,
+                "dispositivos": dispositivos_resumen
             }
         }
         
-        # Intentar obtener dispositivos en tiempo real
-        if api_gps and api_gps.access_token:
+        # La consulta en tiempo real a la API es lenta: solo con ?probe=1
+        if not request.args.get('probe'):
+            diagnostico["test_api"] = {
+                "ejecutado": False,
+                "mensaje": "Añade ?probe=1 para consultar la API en tiempo real"
+            }
+        elif api_gps and api_gps.access_token:
             try:
-                dispositivos_raw = api_gps.listar_dispositivos()
+                dispositivos_raw = api_gps.listar_dispositivos(forzar=True)
                 diagnostico["test_api"] = {
                     "success": True,
                     "total_dispositivos": len(dispositivos_raw) if dispositivos_raw else 0,
@@ -548,15 +919,26 @@ def api_forzar_actualizacion():
                 "error": "API no inicializada o sin token"
             }), 500
         
-        print("\n🔄 Forzando actualización manual...")
-        actualizar_ubicaciones()
+        logger.info("🔄 Forzando actualización manual...")
+        if hilo_actualizacion and hilo_actualizacion.is_alive():
+            # Despertar al bucle en lugar de actualizar aquí: no bloquea la petición
+            # ni lanza una segunda actualización en paralelo con la automática
+            evento_actualizar.set()
+        elif not lanzar_actualizacion():
+            # Proceso sin bucle (no líder o RUN_POLLER=0) y ya hay una en curso
+            return jsonify({
+                "success": False,
+                "error": "Ya hay una actualización en curso",
+                "estado": "/api/forzar-actualizacion/estado"
+            }), 409
         
         return jsonify({
             "success": True,
-            "mensaje": "Actualización forzada completada",
+            "mensaje": "Actualización encolada",
+            "estado": "/api/forzar-actualizacion/estado",
             "dispositivos": len(ubicaciones_actuales),
-            "ultima_actualizacion": ultima_actualizacion.isoformat() if ultima_actualizacion else None
-        })
+            "ultima_actualizacion": ultima_actualizacion_iso
+        }), 202
         
     except Exception as e:
         return jsonify({
@@ -564,83 +946,40 @@ def api_forzar_actualizacion():
             "error": str(e)
         }), 500
 
+@app.route('/api/forzar-actualizacion/estado')
+def api_forzar_actualizacion_estado():
+    """API: Estado de la última actualización (del bucle o forzada manualmente)"""
+    return jsonify(estado_refresco)
+
 @app.route('/api/geojson')
 def api_geojson():
-    """API: Devuelve Puntos y Tracklines combinados"""
+    """API: Devuelve Puntos y Tracklines combinados (?format=geojsonseq para RFC 7464)"""
     try:
         actualizar_si_necesario()
-        features = []
-        
-        # 1. Agregar Puntos (Ubicación actual)
-        for ubicacion in ubicaciones_actuales:
-            feature_punto = {
-                "type": "Feature",
-                "geometry": {
-                    "type": "Point",
-                    "coordinates": [
-                        float(ubicacion.get('lng', 0)),
-                        float(ubicacion.get('lat', 0))
-                    ]
-                },
-                "properties": {
-                    "type": "current_location",
-                    "deviceName": ubicacion.get('deviceName', 'Sin nombre'),
-                    "imei": ubicacion.get('imei'),
-                    "speed": ubicacion.get('speed', 0),
-                    "direction": ubicacion.get('direction', 0),
-                    "accStatus": ubicacion.get('accStatus'),
-                    "gpsTime": ubicacion.get('gpsTime'),
-                    "status": ubicacion.get('status'),
-                    "powerValue": ubicacion.get('powerValue'),
-                    "vehicleState": ubicacion.get('vehicleState', 'DESCONOCIDO'),
-                    "vehicleStateId": ubicacion.get('vehicleStateId', 0),
-                    "fuelLevel": ubicacion.get('fuelLevel', 'N/A')
-                }
-            }
-            features.append(feature_punto)
-
-        # 2. Agregar Rutas (Tracklines)
-        for imei, coords in historial_rutas.items():
-            if len(coords) > 1:
-                # Buscar nombre del dispositivo y datos actuales para enriquecer el trackline
-                nombre = "Desconocido"
-                datos_actuales = {}
-                for u in ubicaciones_actuales:
-                    if u.get('imei') == imei:
-                        nombre = u.get('deviceName', 'Sin nombre')
-                        datos_actuales = u
-                        break
-                
-                feature_ruta = {
-                    "type": "Feature",
-                    "geometry": {
-                        "type": "LineString",
-                        "coordinates": coords
-                    },
-                    "properties": {
-                        "type": "trackline",
-                        "deviceName": nombre,
-                        "imei": imei,
-                        # Agregamos también el estado actual a la línea por si es útil
-                        "vehicleState": datos_actuales.get('vehicleState', 'DESCONOCIDO'),
-                        "vehicleStateId": datos_actuales.get('vehicleStateId', 0),
-                        "fuelLevel": datos_actuales.get('fuelLevel', 'N/A'),
-                        "speed": datos_actuales.get('speed', 0),
-                        "gpsTime": datos_actuales.get('gpsTime', ''),
-                        "direction": datos_actuales.get('direction', 0),
-                        "powerValue": datos_actuales.get('powerValue', 0)
-                    }
-                }
-                features.append(feature_ruta)
-        
-        return jsonify({
-            "type": "FeatureCollection",
-            "features": features,
-            "metadata": {
-                "generated": datetime.now(UTC).isoformat(),
-                "type": "completo"
-            }
-        })
+        etag, variantes = etag_actual, geojson_cache
+        if request.args.get('format') == 'geojsonseq':
+            return respuesta_cacheable(etag, variantes["secuencia"], 'application/geo+json-seq', variantes["secuencia_gz"])
+        return respuesta_cacheable(etag, variantes["completo"], 'application/geo+json', variantes["completo_gz"])
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/geojson/download')
+def api_geojson_descarga():
+    """API: Descarga el GeoJSON combinado como archivo (sin escribir a disco)"""
+    try:
+        actualizar_si_necesario()
+        nombre_archivo = f"ubicaciones_{datetime.now().strftime('%Y%m%d_%H%M%S')}.geojson"
+        contenido = geojson_cache["completo"]
+        tipo = 'application/geo+json'
+        if request.args.get('format') == 'geojsonseq':
+            nombre_archivo += "s"
+            contenido = geojson_cache["secuencia"]
+            tipo = 'application/geo+json-seq'
+        return Response(
+            contenido,
+            mimetype=tipo,
+            headers={"Content-Disposition": f"attachment; filename={nombre_archivo}"}
+        )
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -649,42 +988,8 @@ def api_geojson_puntos():
     """API: Devuelve solo los puntos actuales (optimizado para ArcGIS)"""
     try:
         actualizar_si_necesario()
-        features = []
-        
-        for ubicacion in ubicaciones_actuales:
-            feature = {
-                "type": "Feature",
-                "geometry": {
-                    "type": "Point",
-                    "coordinates": [
-                        float(ubicacion.get('lng', 0)),
-                        float(ubicacion.get('lat', 0))
-                    ]
-                },
-                "properties": {
-                    "deviceName": ubicacion.get('deviceName', 'Sin nombre'),
-                    "imei": ubicacion.get('imei'),
-                    "speed": ubicacion.get('speed', 0),
-                    "direction": ubicacion.get('direction', 0),
-                    "accStatus": ubicacion.get('accStatus'),
-                    "gpsTime": ubicacion.get('gpsTime'),
-                    "status": ubicacion.get('status'),
-                    "powerValue": ubicacion.get('powerValue'),
-                    "vehicleState": ubicacion.get('vehicleState', 'DESCONOCIDO'),
-                    "vehicleStateId": ubicacion.get('vehicleStateId', 0),
-                    "fuelLevel": ubicacion.get('fuelLevel', 'N/A')
-                }
-            }
-            features.append(feature)
-        
-        return jsonify({
-            "type": "FeatureCollection",
-            "features": features,
-            "metadata": {
-                "generated": datetime.now(UTC).isoformat(),
-                "type": "puntos"
-            }
-        })
+        etag, variantes = etag_actual, geojson_cache
+        return respuesta_cacheable(etag, variantes["puntos"], 'application/json', variantes["puntos_gz"])
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -693,54 +998,56 @@ def api_geojson_rutas():
     """API: Devuelve solo las líneas de ruta (optimizado para ArcGIS)"""
     try:
         actualizar_si_necesario()
-        features = []
-        
-        for imei, coords in historial_rutas.items():
-            if len(coords) > 1:
-                # Buscar nombre del dispositivo y datos actuales
-                nombre = "Desconocido"
-                datos_actuales = {}
-                for u in ubicaciones_actuales:
-                    if u.get('imei') == imei:
-                        nombre = u.get('deviceName', 'Sin nombre')
-                        datos_actuales = u
-                        break
-                
-                feature = {
-                    "type": "Feature",
-                    "geometry": {
-                        "type": "LineString",
-                        "coordinates": coords
-                    },
-                    "properties": {
-                        "deviceName": nombre,
-                        "imei": imei,
-                        "speed": datos_actuales.get('speed', 0),
-                        "gpsTime": datos_actuales.get('gpsTime', ''),
-                        "direction": datos_actuales.get('direction', 0),
-                        "powerValue": datos_actuales.get('powerValue', 0),
-                        "vehicleState": datos_actuales.get('vehicleState', 'DESCONOCIDO'),
-                        "vehicleStateId": datos_actuales.get('vehicleStateId', 0),
-                        "fuelLevel": datos_actuales.get('fuelLevel', 'N/A')
-                    }
-                }
-                features.append(feature)
-        
-        return jsonify({
-            "type": "FeatureCollection",
-            "features": features,
-            "metadata": {
-                "generated": datetime.now(UTC).isoformat(),
-                "type": "rutas"
-            }
-        })
+        etag, variantes = etag_actual, geojson_cache
+        return respuesta_cacheable(etag, variantes["rutas"], 'application/json', variantes["rutas_gz"])
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+def es_lider_poller():
+    """Decide si este proceso debe ejecutar el bucle de actualización.
+    
+    Con varios workers de Gunicorn cada uno importa el módulo; solo el que
+    consigue el candado de archivo arranca el hilo, el resto sirve los datos
+    con la actualización bajo demanda de actualizar_si_necesario().
+    
+    Returns:
+        bool: True si este proceso es el encargado de consultar la API
+    """
+    global archivo_lock_poller
+    
+    if RUN_POLLER is not None:
+        return RUN_POLLER == "1"
+    if fcntl is None:
+        return True
+    
+    archivo = open(POLLER_LOCK_FILE, "w")
+    try:
+        fcntl.flock(archivo, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        archivo.close()
+        return False
+    
+    archivo.write(str(os.getpid()))
+    archivo.flush()
+    archivo_lock_poller = archivo
+    return True
+
 # Inicializar la API al importar el módulo (para Gunicorn/Render)
+aplicacion_inicializada = False
+lock_inicializacion = threading.Lock()
+
 def inicializar_aplicacion():
-    """Inicializa la aplicación al arrancar"""
-    global api_gps, ubicaciones_actuales, ultima_actualizacion
+    """Inicializa la aplicación al arrancar.
+    
+    Es idempotente: si el módulo se importa más de una vez en el mismo
+    proceso, el hilo de actualización solo se arranca la primera vez.
+    """
+    global api_gps, ubicaciones_actuales, ultima_actualizacion, aplicacion_inicializada, hilo_actualizacion
+    
+    with lock_inicializacion:
+        if aplicacion_inicializada:
+            return
+        aplicacion_inicializada = True
     
     print("="*80)
     print("🛰️ GPS TRACKER - INICIALIZANDO")
@@ -750,9 +1057,14 @@ def inicializar_aplicacion():
         print("✅ API inicializada, obteniendo primera actualización...")
         actualizar_ubicaciones()
         
+        if not es_lider_poller():
+            print(f"ℹ️ Bucle de actualización a cargo de otro proceso (PID {os.getpid()} en modo bajo demanda)")
+            return
+        
         # Iniciar bucle de actualización en segundo plano
-        hilo = threading.Thread(target=bucle_actualizacion, daemon=True)
-        hilo.start()
+        hilo_actualizacion = threading.Thread(target=bucle_actualizacion, daemon=True)
+        hilo_actualizacion.start()
+        atexit.register(detener_actualizacion_automatica)
         print("✅ Bucle de actualización iniciado")
     else:
         print("❌ No se pudo inicializar la API")
@@ -761,10 +1073,11 @@ def inicializar_aplicacion():
 inicializar_aplicacion()
 
 if __name__ == '__main__':
-    # Iniciar servidor Flask directamente (para desarrollo local)
+    # Iniciar servidor Flask directamente (para desarrollo local).
+    # En producción usar Gunicorn, que lee gunicorn.conf.py: gunicorn app:app
     port = int(os.environ.get('PORT', 5000))
     print(f"\n🌐 Servidor iniciando en puerto {port}")
     print(f"📱 Accede a: http://localhost:{port}")
     print(f"🔄 Actualización automática: cada {CONFIG['INTERVALO']} segundos\n")
     
-    app.run(host='0.0.0.0', port=port, debug=False)
+    app.run(host='0.0.0.0', port=port, debug=False, threaded=True)
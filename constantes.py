@@ -0,0 +1,13 @@
+"""
+CONSTANTES COMPARTIDAS
+======================
+Valores que usan varios scripts y que no dependen de nada más que la
+biblioteca estándar (importarlo no carga requests, dotenv ni credenciales)
+"""
+
+import os
+
+# Marca (por su fecha de modificación) de la última solicitud de token, que es
+# la llamada que limita la API; iniciar_servidor.py la usa para esperar solo
+# cuando hace falta
+MARCA_ULTIMO_TOKEN = os.path.join(os.path.expanduser("~"), ".ordonez-gps", "last_api_call")
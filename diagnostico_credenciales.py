@@ -6,6 +6,7 @@ Lee las credenciales desde el archivo .env
 import hashlib
 import requests
 import os
+from functools import lru_cache
 from datetime import datetime, UTC
 from dotenv import load_dotenv
 
@@ -35,14 +36,17 @@ passwords_to_test = [
     BASE_PASSWORD.replace("ñ", "n"),  # Sin ñ
 ]
 
+# Parámetros de jimi.oauth.token.get ya en orden alfabético (el orden que exige la firma)
+_SIGN_KEYS = ('app_key', 'expires_in', 'format', 'method', 'sign_method', 'timestamp', 'user_id', 'user_pwd_md5', 'v')
+
+@lru_cache(maxsize=32)
 def md5_hash(text):
-    """Convierte un texto a hash MD5"""
+    """Convierte un texto a hash MD5 (las variaciones repetidas se calculan una vez)"""
     return hashlib.md5(text.encode('utf-8')).hexdigest().lower()
 
 def generate_signature(params, app_secret):
-    """Genera la firma MD5"""
-    sorted_items = sorted(params.items())
-    base = "".join([f"{k}{v}" for k, v in sorted_items])
+    """Genera la firma MD5 de una petición de token"""
+    base = "".join(f"{k}{params[k]}" for k in _SIGN_KEYS)
     sign_str = f"{app_secret}{base}{app_secret}"
     return hashlib.md5(sign_str.encode("utf-8")).hexdigest().upper()
 
@@ -1,13 +1,17 @@
 """
 Genera archivos GeoJSON estáticos que puedes compartir o subir a servicios web
 Lee las credenciales desde el archivo .env
+
+Por defecto los archivos se escriben compactos; con --pretty, indentados
 """
 
-import json
+import orjson
 import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from dotenv import load_dotenv
-from main import TrackSolidAPI
+from main import TrackSolidAPI, configurar_logging
 
 # Cargar variables de entorno
 load_dotenv()
@@ -30,18 +34,26 @@ if not all([CONFIG["APP_KEY"], CONFIG["APP_SECRET"], CONFIG["USER_EMAIL"], CONFI
     print("  - TRACKSOLID_PASSWORD")
     exit(1)
 
-def crear_geojson(ubicaciones):
-    """Crea un GeoJSON a partir de las ubicaciones"""
-    features = []
-    
-    for ubicacion in ubicaciones:
-        feature = {
+MAX_HILOS_UBICACIONES = 16  # Consultas de ubicación simultáneas
+CARPETA_SALIDA = "geojson_publicos"
+
+def crear_geojson(ubicaciones, precision=6):
+    """
+    Crea un GeoJSON a partir de las ubicaciones
+    
+    Args:
+        ubicaciones: Lista de ubicaciones de la API
+        precision: Decimales de las coordenadas (6 ≈ 11 cm, más que el ruido del GPS)
+    """
+    # Un Feature por ubicación, construido en una comprensión de lista
+    features = [
+        {
             "type": "Feature",
             "geometry": {
                 "type": "Point",
                 "coordinates": [
-                    float(ubicacion.get('lng', 0)),
-                    float(ubicacion.get('lat', 0))
+                    round(float(ubicacion.get('lng', 0)), precision),
+                    round(float(ubicacion.get('lat', 0)), precision)
                 ]
             },
             "properties": {
@@ -57,7 +69,8 @@ def crear_geojson(ubicaciones):
                 "locDesc": ubicacion.get('locDesc', '')
             }
         }
-        features.append(feature)
+        for ubicacion in ubicaciones
+    ]
     
     geojson = {
         "type": "FeatureCollection",
@@ -71,23 +84,31 @@ def crear_geojson(ubicaciones):
     
     return geojson
 
-def guardar_geojson(geojson, nombre_archivo):
-    """Guarda el GeoJSON en un archivo"""
-    carpeta = "geojson_publicos"
+def guardar_geojson(geojson, nombre_archivo, pretty=False):
+    """
+    Guarda el GeoJSON en un archivo
     
-    # Crear carpeta si no existe
-    if not os.path.exists(carpeta):
-        os.makedirs(carpeta)
+    Args:
+        geojson: FeatureCollection a guardar
+        nombre_archivo: Nombre del archivo dentro de CARPETA_SALIDA (main la crea)
+        pretty: Indentar la salida (para leerla a mano); por defecto compacta
+    """
+    ruta_completa = os.path.join(CARPETA_SALIDA, nombre_archivo)
     
-    ruta_completa = os.path.join(carpeta, nombre_archivo)
+    # orjson escribe UTF-8 directamente (equivale a ensure_ascii=False)
+    opciones = orjson.OPT_APPEND_NEWLINE
+    if pretty:
+        opciones |= orjson.OPT_INDENT_2
     
-    with open(ruta_completa, 'w', encoding='utf-8') as f:
-        json.dump(geojson, f, indent=2, ensure_ascii=False)
+    with open(ruta_completa, 'wb') as f:
+        f.write(orjson.dumps(geojson, option=opciones))
     
     print(f"💾 Guardado: {ruta_completa}")
     return ruta_completa
 
 def main():
+    configurar_logging()
+    pretty = '--pretty' in sys.argv  # Salida indentada, para leerla a mano
     print("="*70)
     print("GENERADOR DE GEOJSON ESTÁTICO")
     print("="*70)
@@ -119,12 +140,16 @@ def main():
     print("\n📍 Obteniendo ubicaciones...")
     ubicaciones = []
     
-    for disp in dispositivos:
+    # Consultas independientes: lanzarlas en paralelo (la sesión HTTP de la API es compartida)
+    with ThreadPoolExecutor(max_workers=min(MAX_HILOS_UBICACIONES, len(dispositivos))) as ex:
+        futuros = [(disp, ex.submit(api.obtener_ubicacion, disp.get('imei'))) for disp in dispositivos]
+    
+    for disp, futuro in futuros:
         imei = disp.get('imei')
         nombre = disp.get('deviceName', 'Sin nombre')
         
         try:
-            ubicacion = api.obtener_ubicacion(imei)
+            ubicacion = futuro.result()
             if ubicacion:
                 ubicacion['deviceName'] = nombre
                 ubicacion['imei'] = imei
@@ -145,19 +170,24 @@ def main():
     
     # Guardar archivos
     print("\n💾 Guardando archivos...")
+    os.makedirs(CARPETA_SALIDA, exist_ok=True)
     
     # Archivo con timestamp
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    guardar_geojson(geojson, f"ubicaciones_{timestamp}.geojson")
+    guardar_geojson(geojson, f"ubicaciones_{timestamp}.geojson", pretty)
     
     # Archivo actual (siempre actualizado)
-    guardar_geojson(geojson, "ubicaciones_actual.geojson")
-    
-    # Archivo por dispositivo
-    for ubicacion in ubicaciones:
-        nombre_dispositivo = ubicacion.get('deviceName', 'sin_nombre').replace(' ', '_')
-        geojson_individual = crear_geojson([ubicacion])
-        guardar_geojson(geojson_individual, f"{nombre_dispositivo}.geojson")
+    guardar_geojson(geojson, "ubicaciones_actual.geojson", pretty)
+    
+    # Archivo por dispositivo: reutilizar los features ya construidos (1 por dispositivo)
+    for feature in geojson["features"]:
+        nombre_dispositivo = feature["properties"]["deviceName"].replace(' ', '_')
+        geojson_individual = {
+            "type": "FeatureCollection",
+            "features": [feature],
+            "metadata": {**geojson["metadata"], "total": 1}
+        }
+        guardar_geojson(geojson_individual, f"{nombre_dispositivo}.geojson", pretty)
     
     print("\n" + "="*70)
     print("✅ PROCESO COMPLETADO")
@@ -0,0 +1,24 @@
+"""
+Configuración de Gunicorn para producción (Render)
+Gunicorn la carga automáticamente al ejecutar: gunicorn app:app
+"""
+
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+
+# Un solo proceso por defecto: las ubicaciones viven en memoria y solo el
+# proceso líder ejecuta el bucle de actualización (ver es_lider_poller en app.py)
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+
+# Hilos por proceso: cada cliente conectado a /api/stream ocupa uno mientras
+# la pestaña está abierta. app.py admite como máximo MAX_CLIENTES_STREAM (8 por
+# defecto; mantenerlo por debajo de threads) y el resto pasa a consultar
+# /api/ubicaciones, así siempre quedan hilos para las rutas JSON
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "16"))
+
+# Margen por encima del plazo de las consultas a la API
+timeout = 180
+graceful_timeout = 30
+keepalive = 5
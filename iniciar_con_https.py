@@ -3,16 +3,54 @@ Script para iniciar el servidor con HTTPS usando ngrok
 Esto te da una URL HTTPS pública instantáneamente
 """
 
+import errno
+import os
+import re
+import select
+import shutil
+import socket
 import subprocess
 import sys
+import threading
 import time
 import requests
-import json
+from functools import lru_cache
+from requests.adapters import HTTPAdapter
 
-def verificar_ngrok():
-    """Verifica si ngrok está instalado"""
+PUERTO_FLASK = 5000
+URL_ESTADO_FLASK = f'http://localhost:{PUERTO_FLASK}/api/estado'
+URL_TUNELES_NGROK = 'http://localhost:4040/api/tunnels'
+TIMEOUT_INICIO_FLASK = 30  # La primera actualización de app.py consulta la API
+TIMEOUT_INICIO_NGROK = 10
+TIMEOUT_RESPALDO_NGROK = 3
+PATRON_URL_NGROK = re.compile(r'msg="started tunnel".*\burl=(https://\S+)')  # Línea del log de ngrok
+BARRA = "=" * 70
+
+# Sesión compartida para los sondeos locales: reutiliza la conexión keep-alive
+# en lugar de abrir un socket nuevo en cada intento del bucle de espera
+SESSION = requests.Session()
+SESSION.mount('http://', HTTPAdapter(pool_connections=2, pool_maxsize=4, max_retries=0))
+
+@lru_cache(maxsize=1)
+def ruta_ngrok():
+    """Ruta del ejecutable de ngrok en el PATH (None si no está instalado)"""
+    return shutil.which('ngrok')
+
+def verificar_ngrok(verificar_version=False):
+    """
+    Verifica si ngrok está instalado
+    
+    Args:
+        verificar_version: Ejecutar 'ngrok version' además de buscarlo en el
+            PATH (lanza un proceso; solo para diagnóstico)
+    """
+    ruta = ruta_ngrok()
+    if ruta and not verificar_version:
+        print(f"✅ ngrok encontrado: {ruta}")
+        return True
+    
     try:
-        result = subprocess.run(['ngrok', 'version'], 
+        result = subprocess.run([ruta or 'ngrok', 'version'], 
                               capture_output=True, 
                               text=True,
                               timeout=5)
@@ -22,140 +60,345 @@ def verificar_ngrok():
     except (FileNotFoundError, subprocess.TimeoutExpired):
         pass
     
-    print("❌ ngrok no está instalado")
-    print("\n📥 Para instalar ngrok:")
-    print("   1. Ve a: https://ngrok.com/download")
-    print("   2. Descarga ngrok para tu sistema")
-    print("   3. Extrae el archivo y agrégalo al PATH")
-    print("   4. (Opcional) Crea cuenta gratis en ngrok.com para más funciones")
+    sys.stdout.write("\n".join([
+        "❌ ngrok no está instalado",
+        "\n📥 Para instalar ngrok:",
+        "   1. Ve a: https://ngrok.com/download",
+        "   2. Descarga ngrok para tu sistema",
+        "   3. Extrae el archivo y agrégalo al PATH",
+        "   4. (Opcional) Crea cuenta gratis en ngrok.com para más funciones",
+    ]) + "\n")
+    sys.stdout.flush()
     return False
 
-def iniciar_servidor_flask():
-    """Inicia el servidor Flask en segundo plano"""
-    print("\n🚀 Iniciando servidor Flask...")
+def esperar_salida(proceso, segundos):
+    """
+    Espera hasta `segundos` a que el proceso termine, despertando en cuanto lo hace
+    
+    Args:
+        proceso: Popen a vigilar
+        segundos: Tiempo máximo de espera
+        
+    Returns:
+        True si el proceso terminó
+    """
+    # En Linux un pidfd se vuelve legible al morir el proceso: poll() despierta al instante
+    if hasattr(os, 'pidfd_open'):
+        try:
+            fd = os.pidfd_open(proceso.pid)
+        except OSError:
+            fd = None  # Ya terminó y fue recogido, o el kernel no lo soporta
+        if fd is not None:
+            try:
+                sondeo = select.poll()
+                sondeo.register(fd, select.POLLIN)
+                sondeo.poll(int(segundos * 1000))
+            finally:
+                os.close(fd)
+            return proceso.poll() is not None
     
     try:
-        proceso = subprocess.Popen(
-            [sys.executable, 'app.py'],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
-        )
+        proceso.wait(timeout=segundos)
+        return True
+    except subprocess.TimeoutExpired:
+        return False
+
+def esperar_primera_salida(procesos):
+    """
+    Bloquea hasta que termine alguno de los procesos, sin despertar periódicamente
+    
+    Args:
+        procesos: Diccionario {nombre: Popen}
         
-        # Esperar a que el servidor inicie
-        print("⏳ Esperando a que el servidor inicie...")
-        time.sleep(5)
+    Returns:
+        Nombre del primer proceso que terminó
+    """
+    if hasattr(os, 'pidfd_open'):
+        fds = {}
+        try:
+            for nombre, proceso in procesos.items():
+                fds[os.pidfd_open(proceso.pid)] = nombre
+            sondeo = select.poll()
+            for fd in fds:
+                sondeo.register(fd, select.POLLIN)
+            # Sin timeout: el kernel nos despierta al morir un hijo (Ctrl+C interrumpe)
+            eventos = sondeo.poll()
+            return fds[eventos[0][0]]
+        except OSError:
+            pass  # pidfd no disponible o un proceso ya fue recogido
+        finally:
+            for fd in fds:
+                os.close(fd)
+    
+    while True:
+        for nombre, proceso in procesos.items():
+            if esperar_salida(proceso, 0.5):
+                return nombre
+
+def detener_procesos(procesos, gracia=2):
+    """
+    Detiene los procesos con SIGTERM y fuerza SIGKILL si no salen a tiempo
+    
+    Args:
+        procesos: Diccionario {nombre: Popen}
+        gracia: Segundos compartidos que se les da para terminar limpiamente
+    """
+    # Avisar a todos primero para que se cierren en paralelo
+    for proceso in procesos.values():
+        if proceso.poll() is None:
+            proceso.terminate()
+    
+    limite = time.monotonic() + gracia
+    for nombre, proceso in procesos.items():
+        if not esperar_salida(proceso, max(0, limite - time.monotonic())):
+            proceso.kill()
+            proceso.wait()
+            print(f"⚠️ {nombre} no respondió a tiempo, forzado a cerrar")
+        print(f"✅ {nombre} detenido")
+
+def esperar_servidor(proceso, url, timeout):
+    """
+    Sondea `url` hasta que responda 200, abortando si el proceso muere antes
+    
+    Args:
+        proceso: Popen del servidor
+        url: URL de salud a consultar
+        timeout: Segundos máximos de espera
         
-        # Verificar que el servidor esté corriendo
+    Returns:
+        True si el servidor respondió, False si murió o se agotó el tiempo
+    """
+    limite = time.monotonic() + timeout
+    while time.monotonic() < limite:
         try:
-            response = requests.get('http://localhost:5000/api/estado', timeout=5)
-            if response.status_code == 200:
-                print("✅ Servidor Flask iniciado correctamente")
-                return proceso
+            if SESSION.get(url, timeout=0.5).status_code == 200:
+                return True
         except requests.exceptions.RequestException:
             pass
         
-        print("⚠️ El servidor puede estar iniciando, continuando...")
-        return proceso
-        
+        if esperar_salida(proceso, 0.2):
+            return False
+    
+    return False
+
+def estado_puerto_flask():
+    """
+    Revisa el puerto de Flask antes de lanzarlo (p. ej. tras una ejecución que no se cerró bien)
+    
+    Returns:
+        'flask' si ya responde un servidor nuestro, 'ocupado' si el puerto lo usa
+        otro proceso, 'libre' en otro caso
+    """
+    try:
+        if SESSION.get(URL_ESTADO_FLASK, timeout=0.3).status_code == 200:
+            return 'flask'
+    except requests.exceptions.RequestException:
+        pass
+    
+    # Sin respuesta HTTP: intentar ocupar el puerto para ver si alguien más lo tiene
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sondeo:
+        # SO_REUSEADDR: un socket en TIME_WAIT de un Flask recién cerrado no cuenta
+        # como ocupado, pero un servidor escuchando sí. En Windows esa opción
+        # permitiría ocupar un puerto en uso (y TIME_WAIT no bloquea el bind)
+        if os.name != 'nt':
+            sondeo.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            sondeo.bind(('', PUERTO_FLASK))
+        except OSError as e:
+            if e.errno == errno.EADDRINUSE:
+                return 'ocupado'
+    return 'libre'
+
+def iniciar_servidor_flask():
+    """Lanza el servidor Flask en segundo plano (sin esperar a que esté listo)"""
+    print("\n🚀 Iniciando servidor Flask...")
+    
+    try:
+        # Hereda la consola: sus logs se ven en vivo y ninguna tubería sin
+        # leer puede llenarse y bloquear al servidor.
+        # close_fds=False + ruta absoluta habilitan posix_spawn; es seguro porque
+        # Python crea sus descriptores como no heredables (PEP 446)
+        return subprocess.Popen([sys.executable, 'app.py'], close_fds=False)
     except Exception as e:
         print(f"❌ Error al iniciar servidor: {e}")
         return None
 
+def esperar_servidor_flask(proceso):
+    """
+    Espera a que el servidor Flask responda
+    
+    Returns:
+        False si el proceso murió durante el arranque
+    """
+    # Esperar a que el servidor responda (o detectar al instante que murió)
+    print("⏳ Esperando a que el servidor inicie...")
+    if esperar_servidor(proceso, URL_ESTADO_FLASK, TIMEOUT_INICIO_FLASK):
+        print("✅ Servidor Flask iniciado correctamente")
+        return True
+    
+    if proceso.poll() is not None:
+        # El error ya salió por consola (stderr heredado)
+        print(f"❌ El servidor Flask terminó con código {proceso.returncode}")
+        return False
+    
+    print("⚠️ El servidor puede estar iniciando, continuando...")
+    return True
+
 def iniciar_ngrok():
-    """Inicia ngrok para crear túnel HTTPS"""
+    """Lanza ngrok para crear el túnel HTTPS (sin esperar a que esté listo)"""
     print("\n🌐 Iniciando túnel HTTPS con ngrok...")
     
     try:
-        proceso = subprocess.Popen(
-            ['ngrok', 'http', '5000', '--log=stdout'],
+        return subprocess.Popen(
+            [ruta_ngrok() or 'ngrok', 'http', str(PUERTO_FLASK), '--log=stdout'],
             stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
+            stderr=subprocess.STDOUT,  # una sola tubería, drenada por leer_log_ngrok
+            text=True,
+            close_fds=False  # ver iniciar_servidor_flask
         )
-        
-        # Esperar a que ngrok inicie
-        time.sleep(3)
-        
-        # Obtener la URL pública de ngrok
-        try:
-            response = requests.get('http://localhost:4040/api/tunnels', timeout=5)
-            if response.status_code == 200:
-                data = response.json()
-                tunnels = data.get('tunnels', [])
-                
-                for tunnel in tunnels:
-                    if tunnel.get('proto') == 'https':
-                        url_https = tunnel.get('public_url')
-                        print(f"\n{'='*70}")
-                        print("✅ TÚNEL HTTPS CREADO EXITOSAMENTE")
-                        print(f"{'='*70}")
-                        print(f"\n🌐 URL PÚBLICA HTTPS:")
-                        print(f"   {url_https}")
-                        print(f"\n📍 URL GEOJSON:")
-                        print(f"   {url_https}/api/geojson")
-                        print(f"\n🗺️ MAPA INTERACTIVO:")
-                        print(f"   {url_https}/")
-                        print(f"\n{'='*70}")
-                        print("\n💡 Esta URL es pública y funciona desde cualquier lugar")
-                        print("⚠️ La URL cambiará cada vez que reinicies ngrok")
-                        print("💎 Crea cuenta gratis en ngrok.com para URLs fijas")
-                        print(f"\n{'='*70}")
-                        
-                        return proceso, url_https
-        except requests.exceptions.RequestException:
-            print("⚠️ No se pudo obtener la URL de ngrok automáticamente")
-            print("   Revisa la consola de ngrok para ver la URL")
-        
-        return proceso, None
-        
     except Exception as e:
         print(f"❌ Error al iniciar ngrok: {e}")
-        return None, None
+        return None
+
+def leer_log_ngrok(proceso, url_lista, resultado):
+    """
+    Lee el log de ngrok (--log=stdout) y publica la primera URL https que aparezca
+    
+    Args:
+        proceso: Popen de ngrok
+        url_lista: Event que se activa al encontrar la URL o al cerrarse el log
+        resultado: Lista donde se agrega la URL encontrada
+    """
+    try:
+        # Seguir leyendo tras encontrar la URL para que la tubería nunca se llene
+        for linea in proceso.stdout:
+            if not url_lista.is_set():
+                coincidencia = PATRON_URL_NGROK.search(linea)
+                if coincidencia:
+                    resultado.append(coincidencia.group(1))
+                    url_lista.set()
+    finally:
+        url_lista.set()  # ngrok terminó: despertar a quien espera
+
+def consultar_url_api_ngrok(proceso):
+    """Respaldo: pregunta la URL https a la API local de ngrok (:4040)"""
+    esperar_servidor(proceso, URL_TUNELES_NGROK, TIMEOUT_RESPALDO_NGROK)
+    
+    try:
+        response = SESSION.get(URL_TUNELES_NGROK, timeout=5)
+        if response.status_code == 200:
+            data = response.json()
+            tunnels = data.get('tunnels', [])
+            
+            for tunnel in tunnels:
+                if tunnel.get('proto') == 'https':
+                    return tunnel.get('public_url')
+    except requests.exceptions.RequestException:
+        pass
+    
+    return None
+
+def obtener_url_ngrok(proceso):
+    """
+    Espera a que ngrok cree el túnel y muestra la URL pública
+    
+    Returns:
+        URL HTTPS pública o None si no se pudo obtener
+    """
+    # ngrok escribe la URL en su log en cuanto el túnel está listo
+    url_lista = threading.Event()
+    resultado = []
+    threading.Thread(target=leer_log_ngrok, args=(proceso, url_lista, resultado), daemon=True).start()
+    url_lista.wait(TIMEOUT_INICIO_NGROK)
+    
+    url_https = resultado[0] if resultado else consultar_url_api_ngrok(proceso)
+    if not url_https:
+        print("⚠️ No se pudo obtener la URL de ngrok automáticamente")
+        print("   Revisa la consola de ngrok para ver la URL")
+        return None
+    
+    # Un solo write para todo el bloque
+    sys.stdout.write(
+        f"\n{BARRA}\n"
+        "✅ TÚNEL HTTPS CREADO EXITOSAMENTE\n"
+        f"{BARRA}\n"
+        f"\n🌐 URL PÚBLICA HTTPS:\n"
+        f"   {url_https}\n"
+        f"\n📍 URL GEOJSON:\n"
+        f"   {url_https}/api/geojson\n"
+        f"\n🗺️ MAPA INTERACTIVO:\n"
+        f"   {url_https}/\n"
+        f"\n{BARRA}\n"
+        "\n💡 Esta URL es pública y funciona desde cualquier lugar\n"
+        "⚠️ La URL cambiará cada vez que reinicies ngrok\n"
+        "💎 Crea cuenta gratis en ngrok.com para URLs fijas\n"
+        f"\n{BARRA}\n"
+    )
+    sys.stdout.flush()
+    
+    return url_https
 
 def main():
-    print("="*70)
-    print("INICIAR SERVIDOR CON HTTPS (usando ngrok)")
-    print("="*70)
+    print(f"{BARRA}\nINICIAR SERVIDOR CON HTTPS (usando ngrok)\n{BARRA}")
     
     # Verificar ngrok
-    if not verificar_ngrok():
+    if not verificar_ngrok(verificar_version='--verificar-version' in sys.argv):
         return
     
-    # Iniciar servidor Flask
-    proceso_flask = iniciar_servidor_flask()
-    if not proceso_flask:
-        print("❌ No se pudo iniciar el servidor Flask")
+    # Reutilizar un servidor que siga activo, o fallar rápido si el puerto es ajeno
+    estado_puerto = estado_puerto_flask()
+    if estado_puerto == 'ocupado':
+        print(f"❌ El puerto {PUERTO_FLASK} está ocupado por otro proceso")
+        print("   Ciérralo antes de iniciar el servidor")
         return
     
-    # Iniciar ngrok
-    proceso_ngrok, url_https = iniciar_ngrok()
+    if estado_puerto == 'flask':
+        print(f"\n♻️ Ya hay un servidor Flask activo en el puerto {PUERTO_FLASK}, se reutilizará")
+        proceso_flask = None
+    else:
+        # Iniciar servidor Flask
+        proceso_flask = iniciar_servidor_flask()
+        if not proceso_flask:
+            print("❌ No se pudo iniciar el servidor Flask")
+            return
+    
+    # Iniciar ngrok a la vez: su túnel apunta al puerto de Flask y funciona en
+    # cuanto Flask acepte conexiones, así que no hace falta esperar a Flask
+    proceso_ngrok = iniciar_ngrok()
     if not proceso_ngrok:
         print("❌ No se pudo iniciar ngrok")
-        proceso_flask.terminate()
+        if proceso_flask:
+            detener_procesos({"Servidor Flask": proceso_flask})
+        return
+    
+    # Ambos arrancan en paralelo; las esperas se solapan
+    if proceso_flask and not esperar_servidor_flask(proceso_flask):
+        print("❌ No se pudo iniciar el servidor Flask")
+        # Flask pudo quedar vivo (p. ej. tras agotar la espera): detener ambos
+        detener_procesos({"ngrok": proceso_ngrok, "Servidor Flask": proceso_flask})
         return
     
+    url_https = obtener_url_ngrok(proceso_ngrok)
+    
     # Mantener los procesos corriendo
     print("\n🟢 SERVIDOR ACTIVO")
     print("\nPresiona Ctrl+C para detener el servidor\n")
     
+    # Un servidor reutilizado no es nuestro: no se vigila ni se detiene al salir
+    procesos = {"ngrok": proceso_ngrok}
+    if proceso_flask:
+        procesos["Servidor Flask"] = proceso_flask
     try:
-        # Esperar indefinidamente
-        while True:
-            time.sleep(1)
+        # Dormir hasta que alguno de los procesos termine o se pulse Ctrl+C
+        caido = esperar_primera_salida(procesos)
+        print(f"\n\n⚠️ {caido} terminó inesperadamente, deteniendo...")
     except KeyboardInterrupt:
         print("\n\n🛑 Deteniendo servidor...")
-        
-        # Detener procesos
-        if proceso_ngrok:
-            proceso_ngrok.terminate()
-            print("✅ ngrok detenido")
-        
-        if proceso_flask:
-            proceso_flask.terminate()
-            print("✅ Servidor Flask detenido")
-        
-        print("\n👋 ¡Hasta pronto!")
+    
+    # Detener procesos y esperar a que liberen el túnel y el puerto
+    detener_procesos(procesos)
+    
+    print("\n👋 ¡Hasta pronto!")
 
 if __name__ == "__main__":
     try:
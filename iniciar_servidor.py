@@ -2,28 +2,67 @@
 Script mejorado para iniciar el servidor con manejo de errores
 """
 
+import os
+import select
+import subprocess
 import time
 import sys
+from constantes import MARCA_ULTIMO_TOKEN  # Sin importar main (ni sus dependencias)
+
+ESPERA_LIMITE_API = 15  # Segundos mínimos entre solicitudes de token
+
+def esperar_interrumpible(segundos):
+    """Espera `segundos`; con una terminal POSIX, pulsar Enter la salta"""
+    if os.name == 'posix' and sys.stdin.isatty():
+        # select despierta en cuanto hay entrada, sin sondear cada segundo
+        listo, _, _ = select.select([sys.stdin], [], [], segundos)
+        if listo:
+            sys.stdin.readline()
+    else:
+        time.sleep(segundos)
 
 print("="*80)
 print("🛰️ GPS TRACKER - INICIANDO SERVIDOR")
 print("="*80)
-print("\n⏳ Esperando para evitar límite de frecuencia de la API...")
-print("   (Esto es normal después de varias pruebas)\n")
 
-# Esperar 15 segundos para evitar límite de frecuencia
-for i in range(15, 0, -1):
-    print(f"\r   Iniciando en {i} segundos...", end="", flush=True)
-    time.sleep(1)
+# Esperar solo lo que falte desde la última solicitud de token (si la hubo)
+try:
+    transcurrido = time.time() - os.path.getmtime(MARCA_ULTIMO_TOKEN)
+except OSError:
+    transcurrido = ESPERA_LIMITE_API
+espera = max(0, ESPERA_LIMITE_API - transcurrido)
+
+if espera > 0:
+    print(f"\n⏳ Esperando {espera:.1f} segundos para evitar límite de frecuencia de la API...")
+    print("   (Esto es normal después de varias pruebas; Enter para no esperar)")
+    try:
+        esperar_interrumpible(espera)
+    except KeyboardInterrupt:
+        print("\n\n🛑 Inicio cancelado por el usuario")
+        sys.exit(0)
+
+print("\n🚀 Iniciando servidor...\n")
+
+# Flask arranca en un intérprete limpio (-u: logs sin búfer)
+ruta_app = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+comando = [sys.executable, '-u', ruta_app]
+sys.stdout.flush()  # exec descarta lo que quede en el búfer
 
-print("\n\n🚀 Iniciando servidor...\n")
+if os.name != 'posix':
+    # En Windows os.exec* lanza un proceso nuevo y devuelve la consola de
+    # inmediato: se espera al servidor para que siga en primer plano con Ctrl+C
+    try:
+        sys.exit(subprocess.call(comando))
+    except KeyboardInterrupt:
+        print("\n🛑 Servidor detenido")
+        sys.exit(0)
+    except OSError as e:
+        print(f"\n❌ Error: {e}")
+        sys.exit(1)
 
-# Importar y ejecutar app
+# POSIX: reemplazar este proceso por el servidor, sin un proceso intermedio esperando
 try:
-    import app
-except KeyboardInterrupt:
-    print("\n\n🛑 Servidor detenido por el usuario")
-    sys.exit(0)
-except Exception as e:
+    os.execvp(sys.executable, comando)
+except OSError as e:
     print(f"\n❌ Error: {e}")
     sys.exit(1)
@@ -1,23 +1,17 @@
 """
 Script para probar las credenciales de TrackSolidPro
 Lee las credenciales desde el archivo .env
-"""
-
-import os
-from dotenv import load_dotenv
-from main import TrackSolidAPI
 
-# Cargar variables de entorno
-load_dotenv()
+Por defecto solo revisa el formato (sin red, no comprueba que sean válidas);
+con --live pide un token a la API
+"""
 
-# Obtener credenciales desde .env
-APP_KEY = os.getenv("TRACKSOLID_APP_KEY")
-APP_SECRET = os.getenv("TRACKSOLID_APP_SECRET")
-USER_EMAIL = os.getenv("TRACKSOLID_EMAIL")
-USER_PASSWORD = os.getenv("TRACKSOLID_PASSWORD")
+import sys
+from dataclasses import astuple
+from main import CREDENCIALES, TrackSolidAPI, configurar_logging
 
-# Verificar que todas las credenciales estén configuradas
-if not all([APP_KEY, APP_SECRET, USER_EMAIL, USER_PASSWORD]):
+# Verificar que todas las credenciales estén configuradas (main las lee de .env)
+if not CREDENCIALES.completas():
     print("❌ ERROR: Faltan credenciales en el archivo .env")
     print("\nPor favor, crea un archivo .env con:")
     print("TRACKSOLID_APP_KEY=tu_app_key")
@@ -27,10 +21,33 @@ if not all([APP_KEY, APP_SECRET, USER_EMAIL, USER_PASSWORD]):
     exit(1)
 
 print("🔐 Probando credenciales desde .env...")
-print(f"   Email: {USER_EMAIL}")
+print(f"   Email: {CREDENCIALES.email}")
+
+# Revisión local del formato: solo avisos, la única prueba real es --live
+# (la cuenta de TrackSolid no tiene por qué ser un email)
+avisos = []
+if len(CREDENCIALES.app_key.strip()) < 8:
+    avisos.append("TRACKSOLID_APP_KEY parece demasiado corta")
+if len(CREDENCIALES.app_secret.strip()) < 8:
+    avisos.append("TRACKSOLID_APP_SECRET parece demasiado corto")
+if any(valor != valor.strip() for valor in astuple(CREDENCIALES)):
+    avisos.append("Hay credenciales con espacios al inicio o al final")
+
+if avisos:
+    print("⚠️ Revisa el formato de las credenciales:")
+    for aviso in avisos:
+        print(f"   - {aviso}")
+else:
+    print("✅ Formato de credenciales sin problemas aparentes")
+
+if '--live' not in sys.argv:
+    print("ℹ️ NO se probaron contra la API: las credenciales pueden seguir siendo incorrectas")
+    print("   Ejecuta con --live para comprobarlas con TrackSolidPro")
+    exit(0)
 
 # Prueba las credenciales
-api = TrackSolidAPI(APP_KEY, APP_SECRET, USER_EMAIL, USER_PASSWORD)
+configurar_logging()
+api = TrackSolidAPI(*astuple(CREDENCIALES))
 
 if api.obtener_token():
     print("✅ Credenciales correctas")
@@ -5,14 +5,132 @@ Script para extraer coordenadas, velocidad y datos de dispositivos GPS
 
 """
 
+import atexit
 import hashlib
+import logging
+import os
+import queue
+import sys
+import orjson
 import requests
-import json
 import time
 import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import astuple, dataclass
 from datetime import datetime, UTC
+from itertools import islice
+from logging.handlers import QueueHandler, QueueListener
 from typing import Dict, List, Optional
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from dotenv import load_dotenv
 from config_endpoints import obtener_endpoint, listar_endpoints
+from constantes import MARCA_ULTIMO_TOKEN
+
+# Variables de .env: se leen una sola vez, al importar el módulo (antes de
+# las constantes que dependen del entorno)
+load_dotenv()
+
+# Mensajes de TrackSolidAPI y del monitoreo. Dentro de app.py se propagan a su
+# configuración de logging; los scripts de consola llaman a configurar_logging()
+logger = logging.getLogger('tracksolid')
+_listener_logs = None
+
+# Tiempo máximo de lectura por petición a la API (segundos); la conexión
+# se limita aparte a ~3 s para no quedar colgados en un host que no responde
+REQUEST_TIMEOUT = int(os.getenv("REQUEST_TIMEOUT", "10"))
+CONNECT_TIMEOUT = 3.05
+
+# Reintentos de las sesiones HTTP (Retry de urllib3) y espera base entre ellos
+REINTENTOS_HTTP = 3
+BACKOFF_HTTP = 0.3
+
+# Peor caso de una petición con todos sus reintentos: cada intento agota conexión
+# y lectura, y entre intentos se duerme el backoff exponencial
+PLAZO_MAX_PETICION = (
+    (REINTENTOS_HTTP + 1) * (CONNECT_TIMEOUT + REQUEST_TIMEOUT)
+    + sum(BACKOFF_HTTP * 2 ** n for n in range(REINTENTOS_HTTP))
+)
+
+# Dispositivos procesados a la vez en cada ciclo del monitoreo automático
+MAX_HILOS_MONITOREO = 16
+
+# IMEIs por consulta de jimi.device.location.get (límite de la API)
+MAX_IMEIS_POR_CONSULTA = 100
+
+# La lista de dispositivos cambia poco: se reutiliza durante 5 minutos
+TTL_DISPOSITIVOS = 300
+
+# Segundos durante los que se reutiliza la última ubicación consultada de un IMEI
+TTL_UBICACION = 30
+
+# Códigos con los que la API rechaza un access_token vencido o inválido
+CODIGOS_TOKEN_VENCIDO = frozenset({1004, 1006})
+
+# Envíos a endpoints externos: headers por defecto (no se modifican) y origen de los datos
+HEADERS_JSON = {'Content-Type': 'application/json'}
+FUENTE_DATOS = "TrackSolidPro"
+
+
+@dataclass(frozen=True, slots=True)
+class Credenciales:
+    """Credenciales de TrackSolidPro (mismo orden que TrackSolidAPI)"""
+    app_key: Optional[str]
+    app_secret: Optional[str]
+    email: Optional[str]
+    password: Optional[str]
+    
+    def completas(self) -> bool:
+        """Indica si están configuradas las cuatro credenciales"""
+        return all(astuple(self))
+
+# Variables de .env, en el orden de los campos de Credenciales
+CLAVES_ENTORNO = ("APP_KEY", "APP_SECRET", "EMAIL", "PASSWORD")
+
+# Credenciales del entorno, leídas en una sola pasada al importar el módulo
+CREDENCIALES = Credenciales(*(os.getenv(f"TRACKSOLID_{clave}") for clave in CLAVES_ENTORNO))
+
+
+def registrar_solicitud_token():
+    """Actualiza la marca de la última solicitud de token (los errores se ignoran)"""
+    try:
+        os.makedirs(os.path.dirname(MARCA_ULTIMO_TOKEN), exist_ok=True)
+        with open(MARCA_ULTIMO_TOKEN, 'w'):
+            pass
+    except OSError:
+        pass
+
+
+def configurar_logging(silencioso: bool = False):
+    """
+    Muestra los mensajes de 'tracksolid' en consola a través de una cola: los
+    hilos solo encolan y un único hilo escribe, así la E/S no frena los envíos
+    
+    Args:
+        silencioso: Si es True, solo se muestran advertencias y errores (--quiet)
+    """
+    global _listener_logs
+    
+    logger.setLevel(logging.WARNING if silencioso else logging.INFO)
+    if _listener_logs is not None:
+        return
+    
+    cola = queue.SimpleQueue()
+    manejador = logging.StreamHandler(sys.stdout)
+    manejador.setFormatter(logging.Formatter("%(message)s"))
+    _listener_logs = QueueListener(cola, manejador)
+    _listener_logs.start()
+    atexit.register(_listener_logs.stop)  # Vacía la cola antes de salir
+    
+    logger.addHandler(QueueHandler(cola))
+    logger.propagate = False
+
+
+def timestamp_utc() -> str:
+    """Fecha y hora UTC actual en el formato que firma la API (YYYY-MM-DD HH:MM:SS)"""
+    # Formateo directo desde gmtime: evita datetime + strftime en cada petición firmada
+    t = time.gmtime()
+    return f"{t.tm_year:04d}-{t.tm_mon:02d}-{t.tm_mday:02d} {t.tm_hour:02d}:{t.tm_min:02d}:{t.tm_sec:02d}"
 
 
 class TrackSolidAPI:
@@ -32,16 +150,78 @@ class TrackSolidAPI:
         """
         self.app_key = app_key
         self.app_secret = app_secret
+        self._secret_bytes = app_secret.encode('utf-8')  # El secreto no cambia: se codifica una vez
+        # Contexto MD5 que ya procesó el secreto inicial de toda firma: se copia en cada una
+        self._md5_firma_base = hashlib.new('md5', self._secret_bytes, usedforsecurity=False)
         self.user_email = user_email
         self.user_password_md5 = self._md5_hash(user_password)
         self.endpoint = "https://us-open.tracksolidpro.com/route/rest"
         self.access_token = None
         self.token_expiration = None  # Timestamp de expiración del token
         self.token_expires_in = 3600  # Duración del token en segundos (1 hora)
+        self._lock_token = threading.Lock()  # Evita renovaciones simultáneas desde varios hilos
+        self._cache_dispositivos = (0.0, None)  # (time.monotonic de la consulta, lista de dispositivos)
+        self._cache_ubicaciones = {}  # {imei: (time.monotonic de la consulta, ubicación)}
+        self._lock_ubicaciones = threading.Lock()
+        
+        # Parámetros fijos de cada método de la API: cada llamada solo agrega
+        # los campos variables (token, timestamp, IMEIs, fechas)
+        comunes = {"app_key": app_key, "format": "json", "sign_method": "md5", "v": "1.0"}
+        self._plantillas = {
+            "jimi.oauth.token.get": {
+                **comunes,
+                "method": "jimi.oauth.token.get",
+                "expires_in": str(self.token_expires_in),
+                "user_id": user_email,
+                "user_pwd_md5": self.user_password_md5
+            },
+            "jimi.user.device.list": {**comunes, "method": "jimi.user.device.list", "target": user_email},
+            "jimi.device.location.get": {**comunes, "method": "jimi.device.location.get"},
+            "jimi.device.track.list": {**comunes, "method": "jimi.device.track.list"}
+        }
         
+        # Sesión HTTP compartida: reutiliza conexiones keep-alive (evita un
+        # handshake TCP+TLS por petición) y soporta consultas en paralelo
+        self.session = requests.Session()
+        self.session.headers['Accept'] = 'application/json'  # Común a todas las peticiones
+        reintentos = Retry(
+            total=REINTENTOS_HTTP,
+            backoff_factor=BACKOFF_HTTP,
+            status_forcelist=[429, 502, 503, 504],
+            allowed_methods=frozenset(['GET', 'POST']),  # Las llamadas a la API son consultas
+            respect_retry_after_header=False  # Sin esperas sin límite (ver reintentos_destino)
+        )
+        self.session.mount(self.endpoint, HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=reintentos))
+        
+        # Endpoints destino (monitoreo): también keep-alive. El POST no es idempotente:
+        # solo se reintenta si la conexión no llegó a establecerse o si el servidor
+        # rechazó el envío sin procesarlo (429/503). Tras un timeout de lectura o
+        # un 502/504 el destino pudo haberlo guardado ya. Retry-After se ignora: un
+        # valor alto dejaría un hilo dormido dentro de urllib3 sin que detener() pueda
+        # interrumpirlo; entre intentos solo se espera el backoff exponencial
+        reintentos_destino = Retry(
+            total=REINTENTOS_HTTP,
+            connect=REINTENTOS_HTTP,
+            read=0,
+            other=0,
+            backoff_factor=BACKOFF_HTTP,
+            status_forcelist=[429, 503],
+            allowed_methods=frozenset(['POST']),
+            respect_retry_after_header=False
+        )
+        adaptador_destino = HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=reintentos_destino)
+        self.session.mount('https://', adaptador_destino)
+        self.session.mount('http://', adaptador_destino)
+        
+    def cerrar(self):
+        """Cierra las conexiones keep-alive de la sesión compartida"""
+        self.session.close()
+    
     def _md5_hash(self, text: str) -> str:
         """Convierte un texto a hash MD5"""
-        return hashlib.md5(text.encode('utf-8')).hexdigest().lower()
+        # MD5 aquí no es una protección criptográfica: usedforsecurity=False
+        # evita el control FIPS de OpenSSL 3
+        return hashlib.new('md5', text.encode('utf-8'), usedforsecurity=False).hexdigest()
     
     def _generate_signature(self, params: dict) -> str:
         """
@@ -53,17 +233,16 @@ class TrackSolidAPI:
         Returns:
             Firma MD5 en mayúsculas
         """
-        # Ordenar parámetros alfabéticamente
-        sorted_items = sorted(params.items())
-        
-        # Crear cadena concatenada
-        base = "".join([f"{k}{v}" for k, v in sorted_items])
-        
-        # Agregar secret al inicio y al final
-        sign_str = f"{self.app_secret}{base}{self.app_secret}"
+        # Secret al inicio y al final, parámetros ordenados alfabéticamente en medio;
+        # se van pasando al hash por partes, sin armar la cadena completa
+        h = self._md5_firma_base.copy()
+        for k, v in sorted(params.items()):
+            h.update(k.encode("utf-8"))
+            h.update(str(v).encode("utf-8"))
+        h.update(self._secret_bytes)
         
         # Calcular MD5 y convertir a mayúsculas
-        return hashlib.md5(sign_str.encode("utf-8")).hexdigest().upper()
+        return h.hexdigest().upper()
     
     def _make_request(self, params: dict) -> Optional[dict]:
         """
@@ -75,21 +254,64 @@ class TrackSolidAPI:
         Returns:
             Respuesta JSON o None si hay error
         """
-        headers = {
-            'Content-Type': 'application/x-www-form-urlencoded',
-            'Accept': 'application/json'
-        }
-        
+        # Accept viene de la sesión; requests pone el Content-Type
+        # application/x-www-form-urlencoded al recibir un dict en data
         try:
-            response = requests.post(self.endpoint, data=params, headers=headers)
+            response = self.session.post(
+                self.endpoint,
+                data=params,
+                timeout=(CONNECT_TIMEOUT, REQUEST_TIMEOUT)
+            )
             response.raise_for_status()
-            return response.json()
+            # orjson lee los bytes tal cual: sin decodificar antes el cuerpo a str
+            # (el historial de ruta puede traer miles de puntos)
+            return orjson.loads(response.content)
         except requests.exceptions.RequestException as e:
-            print(f"❌ Error en la petición: {str(e)}")
+            logger.error("❌ Error en la petición: %s", e)
             if hasattr(e, 'response') and e.response is not None:
-                print(f"Respuesta del servidor: {e.response.text}")
+                logger.error("Respuesta del servidor: %s", e.response.text)
+            return None
+        except orjson.JSONDecodeError as e:
+            logger.error("❌ Respuesta no válida de la API: %s", e)
             return None
     
+    def _make_signed_request(self, metodo: str, campos: dict) -> Optional[dict]:
+        """
+        Realiza una petición firmada con el access_token actual. Si la API
+        rechaza el token (p. ej. vencido antes de lo previsto), lo renueva
+        una sola vez y repite la petición
+        
+        Args:
+            metodo: Método de la API (clave de self._plantillas)
+            campos: Parámetros variables de la petición (IMEIs, fechas...)
+            
+        Returns:
+            Respuesta JSON o None si hay error
+        """
+        for intento in range(2):
+            token_usado = self.access_token
+            params = {
+                **self._plantillas[metodo],
+                **campos,
+                "access_token": token_usado,
+                "timestamp": timestamp_utc()
+            }
+            params["sign"] = self._generate_signature(params)
+            response = self._make_request(params)
+            
+            if intento == 0 and response and response.get('code') in CODIGOS_TOKEN_VENCIDO:
+                with self._lock_token:
+                    # Si otro hilo ya lo renovó, basta con repetir con el token nuevo
+                    if self.access_token == token_usado:
+                        logger.warning("🔄 La API rechazó el token (código %s), renovando...", response.get('code'))
+                        if not self.obtener_token(forzar=True):
+                            return response
+                continue
+            
+            return response
+        
+        return response
+    
     def obtener_token(self, forzar: bool = False) -> bool:
         """
         Obtiene el token de acceso de la API
@@ -104,38 +326,29 @@ class TrackSolidAPI:
         if not forzar and self.access_token and self.token_expiration:
             tiempo_restante = (self.token_expiration - time.time())
             if tiempo_restante > 300:  # Si quedan más de 5 minutos
-                print(f"ℹ️ Token aún válido (expira en {int(tiempo_restante/60)} minutos)")
+                logger.info("ℹ️ Token aún válido (expira en %d minutos)", int(tiempo_restante / 60))
                 return True
         
-        timestamp = datetime.now(UTC).strftime("%Y-%m-%d %H:%M:%S")
-        
-        params = {
-            "app_key": self.app_key,
-            "expires_in": str(self.token_expires_in),
-            "format": "json",
-            "method": "jimi.oauth.token.get",
-            "sign_method": "md5",
-            "timestamp": timestamp,
-            "user_id": self.user_email,
-            "user_pwd_md5": self.user_password_md5,
-            "v": "1.0"
-        }
+        timestamp = timestamp_utc()
+        
+        params = {**self._plantillas["jimi.oauth.token.get"], "timestamp": timestamp}
         
         # Generar firma
         params["sign"] = self._generate_signature(params)
         
-        print("🔑 Solicitando token de acceso...")
+        logger.info("🔑 Solicitando token de acceso...")
+        registrar_solicitud_token()
         response = self._make_request(params)
         
         if response and response.get('code') == 0:
             self.access_token = response['result']['accessToken']
             # Calcular tiempo de expiración (restar 5 minutos como margen de seguridad)
             self.token_expiration = time.time() + self.token_expires_in - 300
-            print(f"✅ Token obtenido: {self.access_token[:20]}...")
-            print(f"   Expira en: {self.token_expires_in/60} minutos")
+            logger.info("✅ Token obtenido: %s...", self.access_token[:20])
+            logger.info("   Expira en: %s minutos", self.token_expires_in / 60)
             return True
         else:
-            print(f"❌ Error al obtener token: {response}")
+            logger.error("❌ Error al obtener token: %s", response)
             return False
     
     def verificar_y_renovar_token(self) -> bool:
@@ -145,100 +358,153 @@ class TrackSolidAPI:
         Returns:
             True si el token es válido o se renovó exitosamente
         """
-        if not self.access_token or not self.token_expiration:
-            print("⚠️ No hay token, obteniendo uno nuevo...")
-            return self.obtener_token()
-        
-        tiempo_restante = self.token_expiration - time.time()
-        
-        # Si quedan menos de 5 minutos, renovar
-        if tiempo_restante < 300:
-            print(f"🔄 Token por expirar (quedan {int(tiempo_restante/60)} minutos), renovando...")
-            return self.obtener_token(forzar=True)
-        
-        return True
+        with self._lock_token:
+            if not self.access_token or not self.token_expiration:
+                logger.warning("⚠️ No hay token, obteniendo uno nuevo...")
+                return self.obtener_token()
+            
+            tiempo_restante = self.token_expiration - time.time()
+            
+            # Si quedan menos de 5 minutos, renovar
+            if tiempo_restante < 300:
+                logger.info("🔄 Token por expirar (quedan %d minutos), renovando...", int(tiempo_restante / 60))
+                return self.obtener_token(forzar=True)
+            
+            return True
     
-    def listar_dispositivos(self) -> Optional[List[dict]]:
+    def listar_dispositivos(self, forzar: bool = False) -> Optional[List[dict]]:
         """
-        Lista todos los dispositivos de la cuenta
+        Lista todos los dispositivos de la cuenta (reutiliza la última lista
+        durante TTL_DISPOSITIVOS segundos)
+        
+        Args:
+            forzar: Si es True, consulta la API aunque haya una lista reciente
         
         Returns:
             Lista de dispositivos o None si hay error
         """
+        # Fecha y lista van en una sola tupla: se leen y se reemplazan juntas
+        cache_ts, cache_lista = self._cache_dispositivos
+        if not forzar and cache_lista is not None and time.monotonic() - cache_ts < TTL_DISPOSITIVOS:
+            return cache_lista
+        
         # Verificar y renovar token si es necesario
         if not self.verificar_y_renovar_token():
-            print("⚠️ No se pudo obtener/renovar el token")
+            logger.warning("⚠️ No se pudo obtener/renovar el token")
             return None
         
-        timestamp = datetime.now(UTC).strftime("%Y-%m-%d %H:%M:%S")
-        
-        params = {
-            "access_token": self.access_token,
-            "app_key": self.app_key,
-            "format": "json",
-            "method": "jimi.user.device.list",
-            "sign_method": "md5",
-            "target": self.user_email,
-            "timestamp": timestamp,
-            "v": "1.0"
-        }
-        
-        params["sign"] = self._generate_signature(params)
-        
-        print("📱 Obteniendo lista de dispositivos...")
-        response = self._make_request(params)
+        logger.info("📱 Obteniendo lista de dispositivos...")
+        response = self._make_signed_request("jimi.user.device.list", {})
         
         if response and response.get('code') == 0:
             dispositivos = response.get('result', [])
-            print(f"✅ Se encontraron {len(dispositivos)} dispositivos")
+            logger.info("✅ Se encontraron %d dispositivos", len(dispositivos))
+            self._cache_dispositivos = (time.monotonic(), dispositivos)
             return dispositivos
         else:
-            print(f"❌ Error al listar dispositivos: {response}")
+            logger.error("❌ Error al listar dispositivos: %s", response)
             return None
     
-    def obtener_ubicacion(self, imei: str) -> Optional[dict]:
+    def _guardar_ubicaciones(self, pares):
         """
-        Obtiene la ubicación actual de un dispositivo
+        Guarda ubicaciones recién consultadas en el cache por IMEI
+        
+        Args:
+            pares: Iterable de (IMEI solicitado, ubicación); la clave es el IMEI
+                con el que se consultará después, no el que trae la respuesta
+        """
+        ahora = time.monotonic()
+        with self._lock_ubicaciones:
+            for imei, ubicacion in pares:
+                self._cache_ubicaciones[imei] = (ahora, ubicacion)
+    
+    def invalidar_ubicaciones(self, imei: Optional[str] = None):
+        """Descarta la ubicación en cache de un IMEI (o de todos si no se indica)"""
+        with self._lock_ubicaciones:
+            if imei is None:
+                self._cache_ubicaciones.clear()
+            else:
+                self._cache_ubicaciones.pop(imei, None)
+    
+    def obtener_ubicacion(self, imei: str, forzar: bool = False, ttl: float = TTL_UBICACION) -> Optional[dict]:
+        """
+        Obtiene la ubicación actual de un dispositivo, reutilizando la consulta
+        de hace menos de `ttl` segundos si la hay
         
         Args:
             imei: IMEI del dispositivo
+            forzar: Si es True, consulta la API aunque haya una ubicación reciente
+            ttl: Antigüedad máxima (segundos) de una ubicación reutilizable
             
         Returns:
-            Datos de ubicación o None si hay error
+            Copia de los datos de ubicación o None si hay error
         """
+        if not forzar:
+            with self._lock_ubicaciones:
+                entrada = self._cache_ubicaciones.get(imei)
+            if entrada and time.monotonic() - entrada[0] < ttl:
+                return dict(entrada[1])
+        
         # Verificar y renovar token si es necesario
         if not self.verificar_y_renovar_token():
-            print("⚠️ No se pudo obtener/renovar el token")
+            logger.warning("⚠️ No se pudo obtener/renovar el token")
             return None
         
-        timestamp = datetime.now(UTC).strftime("%Y-%m-%d %H:%M:%S")
-        
-        params = {
-            "access_token": self.access_token,
-            "app_key": self.app_key,
-            "format": "json",
-            "imeis": imei,
-            "method": "jimi.device.location.get",
-            "sign_method": "md5",
-            "timestamp": timestamp,
-            "v": "1.0"
-        }
-        
-        params["sign"] = self._generate_signature(params)
-        
-        print(f"📍 Obteniendo ubicación del dispositivo {imei}...")
-        response = self._make_request(params)
+        logger.debug("📍 Obteniendo ubicación del dispositivo %s...", imei)
+        response = self._make_signed_request("jimi.device.location.get", {"imeis": imei})
         
         if response and response.get('code') == 0:
             ubicaciones = response.get('result', [])
             if ubicaciones:
-                return ubicaciones[0]
+                self._guardar_ubicaciones([(imei, ubicaciones[0])])
+                return dict(ubicaciones[0])
             else:
-                print("⚠️ No se encontraron datos de ubicación")
+                logger.warning("⚠️ No se encontraron datos de ubicación")
                 return None
         else:
-            print(f"❌ Error al obtener ubicación: {response}")
+            logger.error("❌ Error al obtener ubicación: %s", response)
+            return None
+    
+    def obtener_ubicaciones(self, imeis: List[str]) -> Optional[List[dict]]:
+        """
+        Obtiene la ubicación actual de varios dispositivos en una sola petición
+        (o una por cada bloque de MAX_IMEIS_POR_CONSULTA)
+        
+        Args:
+            imeis: Lista de IMEIs
+            
+        Returns:
+            Lista de ubicaciones (una por IMEI con datos) o None si hay error
+        """
+        # Verificar y renovar token si es necesario
+        if not self.verificar_y_renovar_token():
+            logger.warning("⚠️ No se pudo obtener/renovar el token")
             return None
+        
+        ubicaciones = []
+        for inicio in range(0, len(imeis), MAX_IMEIS_POR_CONSULTA):
+            bloque = imeis[inicio:inicio + MAX_IMEIS_POR_CONSULTA]
+            
+            logger.debug("📍 Obteniendo ubicación de %d dispositivos...", len(bloque))
+            response = self._make_signed_request("jimi.device.location.get", {"imeis": ",".join(bloque)})
+            
+            if response and response.get('code') == 0:
+                resultado = response.get('result') or []
+                ubicaciones.extend(resultado)
+                
+                # Solo se guardan los registros que corresponden a un IMEI pedido
+                # (normalizado a str); los que no traen 'imei' no se pueden asociar
+                solicitados = set(bloque)
+                self._guardar_ubicaciones(
+                    (imei, ubicacion)
+                    for ubicacion in resultado
+                    if (imei := str(ubicacion.get('imei') or '').strip()) in solicitados
+                )
+            else:
+                logger.error("❌ Error al obtener ubicaciones: %s", response)
+                return None
+        
+        return ubicaciones
     
     def obtener_historial_ruta(self, imei: str, fecha_inicio: str, fecha_fin: str) -> Optional[List[dict]]:
         """
@@ -254,35 +520,21 @@ class TrackSolidAPI:
         """
         # Verificar y renovar token si es necesario
         if not self.verificar_y_renovar_token():
-            print("⚠️ No se pudo obtener/renovar el token")
+            logger.warning("⚠️ No se pudo obtener/renovar el token")
             return None
         
-        timestamp = datetime.now(UTC).strftime("%Y-%m-%d %H:%M:%S")
-        
-        params = {
-            "access_token": self.access_token,
-            "app_key": self.app_key,
-            "begin_time": fecha_inicio,
-            "end_time": fecha_fin,
-            "format": "json",
-            "imei": imei,
-            "method": "jimi.device.track.list",
-            "sign_method": "md5",
-            "timestamp": timestamp,
-            "v": "1.0"
-        }
-        
-        params["sign"] = self._generate_signature(params)
-        
-        print(f"🛣️ Obteniendo historial de ruta...")
-        response = self._make_request(params)
+        logger.info("🛣️ Obteniendo historial de ruta...")
+        response = self._make_signed_request(
+            "jimi.device.track.list",
+            {"begin_time": fecha_inicio, "end_time": fecha_fin, "imei": imei}
+        )
         
         if response and response.get('code') == 0:
             ruta = response.get('result', [])
-            print(f"✅ Se encontraron {len(ruta)} puntos en la ruta")
+            logger.info("✅ Se encontraron %d puntos en la ruta", len(ruta))
             return ruta
         else:
-            print(f"❌ Error al obtener historial: {response}")
+            logger.error("❌ Error al obtener historial: %s", response)
             return None
     
     def enviar_datos_a_endpoint(self, endpoint_url: str, datos: dict, headers: Optional[dict] = None) -> bool:
@@ -297,34 +549,83 @@ class TrackSolidAPI:
         Returns:
             True si se envió correctamente, False si hubo error
         """
-        if headers is None:
-            headers = {'Content-Type': 'application/json'}
+        # El cuerpo va ya serializado: el Content-Type JSON se pone siempre,
+        # salvo que los headers personalizados indiquen otro
+        headers = {**HEADERS_JSON, **headers} if headers else HEADERS_JSON
         
         try:
-            print(f"📤 Enviando datos a: {endpoint_url}")
+            logger.info("📤 Enviando datos a: %s", endpoint_url)
             
             # Agregar timestamp y metadata
             payload = {
                 "timestamp": datetime.now(UTC).isoformat(),
-                "source": "TrackSolidPro",
+                "source": FUENTE_DATOS,
                 "data": datos
             }
             
-            response = requests.post(endpoint_url, json=payload, headers=headers, timeout=30)
+            response = self.session.post(
+                endpoint_url,
+                data=orjson.dumps(payload),  # bytes directos, sin pasar por el módulo json
+                headers=headers,
+                timeout=(CONNECT_TIMEOUT, REQUEST_TIMEOUT)
+            )
             response.raise_for_status()
             
-            print(f"✅ Datos enviados exitosamente")
-            print(f"   Status: {response.status_code}")
-            if response.text:
-                print(f"   Respuesta: {response.text[:100]}...")
+            logger.info("✅ Datos enviados exitosamente")
+            logger.info("   Status: %s", response.status_code)
+            if response.content and logger.isEnabledFor(logging.INFO):
+                # Solo se decodifica lo que se muestra, no el cuerpo completo
+                logger.info("   Respuesta: %s...", response.content[:100].decode('utf-8', 'replace'))
             
             return True
             
         except requests.exceptions.RequestException as e:
-            print(f"❌ Error al enviar datos: {str(e)}")
+            logger.error("❌ Error al enviar datos: %s", e)
             if hasattr(e, 'response') and e.response is not None:
-                print(f"   Status: {e.response.status_code}")
-                print(f"   Respuesta: {e.response.text}")
+                logger.error("   Status: %s", e.response.status_code)
+                logger.error("   Respuesta: %s", e.response.text)
+            return False
+    
+    def enviar_lote_a_endpoint(self, endpoint_url: str, ubicaciones: List[dict], headers: Optional[dict] = None) -> Optional[bool]:
+        """
+        Envía varias ubicaciones en una sola petición ("data" es una lista y se
+        agrega el header X-Batch: true para que el endpoint reconozca el formato)
+        
+        Args:
+            endpoint_url: URL del endpoint destino
+            ubicaciones: Lista de ubicaciones a enviar
+            headers: Headers adicionales para la petición
+            
+        Returns:
+            True si se envió, None si el endpoint lo rechazó con un 4xx (no acepta
+            lotes) y False si hubo otro error
+        """
+        headers = {**HEADERS_JSON, **(headers or {}), 'X-Batch': 'true'}
+        payload = {
+            "timestamp": datetime.now(UTC).isoformat(),
+            "source": FUENTE_DATOS,
+            "batch": True,
+            "data": ubicaciones
+        }
+        
+        try:
+            logger.info("📤 Enviando lote de %d ubicaciones a: %s", len(ubicaciones), endpoint_url)
+            response = self.session.post(
+                endpoint_url,
+                data=orjson.dumps(payload),
+                headers=headers,
+                timeout=(CONNECT_TIMEOUT, REQUEST_TIMEOUT)
+            )
+            if 400 <= response.status_code < 500:
+                logger.warning("⚠️ El endpoint rechazó el lote (status %s)", response.status_code)
+                return None
+            response.raise_for_status()
+            
+            logger.info("✅ Lote enviado exitosamente (status %s)", response.status_code)
+            return True
+            
+        except requests.exceptions.RequestException as e:
+            logger.error("❌ Error al enviar el lote: %s", e)
             return False
     
     def enviar_ubicacion_a_endpoint(self, imei: str, endpoint_url: str, headers: Optional[dict] = None) -> bool:
@@ -343,11 +644,58 @@ class TrackSolidAPI:
         ubicacion = self.obtener_ubicacion(imei)
         
         if not ubicacion:
-            print("❌ No se pudo obtener la ubicación del dispositivo")
+            logger.error("❌ No se pudo obtener la ubicación del dispositivo")
             return False
         
         # Enviar datos al endpoint
         return self.enviar_datos_a_endpoint(endpoint_url, ubicacion, headers)
+    
+    def enviar_ubicaciones_a_endpoint(self, imeis: List[str], endpoint_url: str, headers: Optional[dict] = None, lote: bool = False) -> Dict[str, bool]:
+        """
+        Obtiene la ubicación de varios dispositivos en una consulta por lotes y
+        las envía al endpoint: en una sola petición si `lote`, o una por
+        dispositivo en paralelo
+        
+        Args:
+            imeis: Lista de IMEIs
+            endpoint_url: URL del endpoint destino
+            headers: Headers adicionales para la petición
+            lote: Si es True, intenta primero un único envío con todas las
+                  ubicaciones; si el endpoint responde 4xx, envía una por una
+            
+        Returns:
+            Diccionario {imei: True si se envió correctamente}
+        """
+        ubicaciones = self.obtener_ubicaciones(imeis)
+        if ubicaciones is None:
+            return dict.fromkeys(imeis, False)
+        
+        ubicacion_por_imei = {u.get('imei'): u for u in ubicaciones}
+        resultados = dict.fromkeys(imeis, False)
+        con_ubicacion = [imei for imei in imeis if imei in ubicacion_por_imei]
+        if not con_ubicacion:
+            return resultados
+        
+        if lote:
+            enviado = self.enviar_lote_a_endpoint(endpoint_url, [ubicacion_por_imei[imei] for imei in con_ubicacion], headers)
+            if enviado is not None:
+                resultados.update(dict.fromkeys(con_ubicacion, enviado))
+                return resultados
+            logger.info("ℹ️ Enviando una ubicación por petición...")
+        
+        # Cada envío solo espera la red: en paralelo, sobre la sesión compartida
+        with ThreadPoolExecutor(max_workers=min(MAX_HILOS_MONITOREO, len(con_ubicacion))) as executor:
+            futuros = {
+                executor.submit(self.enviar_datos_a_endpoint, endpoint_url, ubicacion_por_imei[imei], headers): imei
+                for imei in con_ubicacion
+            }
+            for futuro in as_completed(futuros):
+                try:
+                    resultados[futuros[futuro]] = futuro.result()
+                except Exception as e:
+                    logger.error("❌ Error al enviar %s: %s", futuros[futuro], e)
+        
+        return resultados
 
 
 class MonitorAutomatico:
@@ -363,12 +711,38 @@ class MonitorAutomatico:
         self.endpoint_url = None
         self.headers = None
         self.dispositivos_monitoreados = []
-        self.estadisticas = {
-            'total_envios': 0,
-            'envios_exitosos': 0,
-            'errores': 0,
-            'inicio': None
-        }
+        self._filtro_imeis = frozenset()  # Mismos IMEIs, para comprobar pertenencia en O(1)
+        self._evento_detener = threading.Event()  # Despierta al hilo en espera al detener
+        self._proximo_ciclo = 0.0  # time.monotonic en que debe empezar el siguiente ciclo
+        
+        # Contadores del monitoreo: se suman juntos bajo el lock para que
+        # estado() y detener() siempre lean una foto consistente
+        self._lock_estadisticas = threading.Lock()
+        self.total_envios = 0
+        self.envios_exitosos = 0
+        self.errores = 0
+        self.ciclos_atrasados = 0
+        self.inicio = None
+    
+    @property
+    def estadisticas(self) -> dict:
+        """Foto consistente de los contadores del monitoreo"""
+        with self._lock_estadisticas:
+            return {
+                'total_envios': self.total_envios,
+                'envios_exitosos': self.envios_exitosos,
+                'errores': self.errores,
+                'ciclos_atrasados': self.ciclos_atrasados,
+                'inicio': self.inicio
+            }
+    
+    def _registrar(self, envios: int = 0, exitosos: int = 0, errores: int = 0, ciclos_atrasados: int = 0):
+        """Suma a los contadores del monitoreo en una sola operación"""
+        with self._lock_estadisticas:
+            self.total_envios += envios
+            self.envios_exitosos += exitosos
+            self.errores += errores
+            self.ciclos_atrasados += ciclos_atrasados
     
     def configurar(self, intervalo: int, endpoint_url: str, headers: Optional[dict] = None, dispositivos: Optional[List[str]] = None):
         """
@@ -388,6 +762,7 @@ class MonitorAutomatico:
         self.endpoint_url = endpoint_url
         self.headers = headers
         self.dispositivos_monitoreados = dispositivos or []
+        self._filtro_imeis = frozenset(self.dispositivos_monitoreados)
         
         print(f"✅ Monitoreo configurado:")
         print(f"   Intervalo: {intervalo} segundos")
@@ -396,72 +771,120 @@ class MonitorAutomatico:
         
         return True
     
+    def _esperar_siguiente_ciclo(self):
+        """
+        Espera hasta el inicio del siguiente ciclo o hasta que se detenga el monitoreo
+        
+        Los ciclos empiezan cada `intervalo` segundos contados desde el inicio del
+        anterior (no desde su final), así el tiempo de trabajo no se acumula
+        """
+        if self._evento_detener.is_set():
+            return
+        
+        self._proximo_ciclo += self.intervalo
+        espera = self._proximo_ciclo - time.monotonic()
+        
+        if espera < 0:
+            # El ciclo tardó más que el intervalo: empezar ya en lugar de arrastrar el retraso
+            self._registrar(ciclos_atrasados=1)
+            logger.warning("⚠️ El ciclo tardó %.1fs, más que el intervalo; continuando sin esperar\n", self.intervalo - espera)
+            self._proximo_ciclo = time.monotonic()
+            return
+        
+        logger.info("⏳ Esperando %.1f segundos...\n", espera)
+        self._evento_detener.wait(espera)
+    
     def _monitorear(self):
         """Función interna que ejecuta el monitoreo en bucle"""
-        self.estadisticas['inicio'] = datetime.now()
-        print(f"\n🚀 Iniciando monitoreo automático cada {self.intervalo} segundos...")
-        print("Presiona Ctrl+C para detener\n")
+        self.inicio = datetime.now()
+        self._proximo_ciclo = time.monotonic()
+        logger.info("\n🚀 Iniciando monitoreo automático cada %d segundos...", self.intervalo)
+        logger.info("Presiona Ctrl+C para detener\n")
         
-        while self.activo:
+        while not self._evento_detener.is_set():
             try:
-                # Obtener lista de dispositivos a monitorear
-                if self.dispositivos_monitoreados:
-                    # Monitorear solo dispositivos específicos
-                    dispositivos_a_procesar = []
-                    todos_dispositivos = self.api.listar_dispositivos()
-                    if todos_dispositivos:
-                        for disp in todos_dispositivos:
-                            if disp.get('imei') in self.dispositivos_monitoreados:
-                                dispositivos_a_procesar.append(disp)
+                # Obtener lista de dispositivos a monitorear (todos, o solo los elegidos)
+                todos_dispositivos = self.api.listar_dispositivos() or []
+                if self._filtro_imeis:
+                    dispositivos_a_procesar = [d for d in todos_dispositivos if d.get('imei') in self._filtro_imeis]
                 else:
-                    # Monitorear todos los dispositivos
-                    dispositivos_a_procesar = self.api.listar_dispositivos()
+                    dispositivos_a_procesar = todos_dispositivos
                 
                 if not dispositivos_a_procesar:
-                    print("⚠️ No hay dispositivos para monitorear")
-                    time.sleep(self.intervalo)
+                    logger.warning("⚠️ No hay dispositivos para monitorear")
+                    self._esperar_siguiente_ciclo()
                     continue
                 
                 # Procesar cada dispositivo
                 timestamp = datetime.now().strftime("%H:%M:%S")
-                print(f"🔄 [{timestamp}] Procesando {len(dispositivos_a_procesar)} dispositivos...")
+                logger.info("🔄 [%s] Procesando %d dispositivos...", timestamp, len(dispositivos_a_procesar))
                 
+                # Una sola consulta de ubicación para todos los dispositivos
+                ubicaciones = self.api.obtener_ubicaciones([d.get('imei') for d in dispositivos_a_procesar])
+                if ubicaciones is None:
+                    self._registrar(errores=1)
+                    self._esperar_siguiente_ciclo()
+                    continue
+                if self._evento_detener.is_set():  # Detenido durante la consulta: no enviar
+                    break
+                
+                ubicacion_por_imei = {u.get('imei'): u for u in ubicaciones}
+                
+                # Sin ubicación no hay nada que enviar: cuenta como envío fallido
                 for dispositivo in dispositivos_a_procesar:
-                    if not self.activo:  # Verificar si se debe detener
-                        break
-                    
-                    imei = dispositivo.get('imei')
-                    nombre = dispositivo.get('deviceName', 'Sin nombre')
-                    
-                    self.estadisticas['total_envios'] += 1
+                    if dispositivo.get('imei') not in ubicacion_por_imei:
+                        self._registrar(envios=1, errores=1)
+                        logger.error("   ❌ %s (%s): sin ubicación", dispositivo.get('deviceName', 'Sin nombre'), dispositivo.get('imei'))
+                
+                # Envíos en paralelo: cada uno espera un viaje de red al destino.
+                # Las estadísticas solo se actualizan aquí, en el hilo del monitor
+                con_ubicacion = [d for d in dispositivos_a_procesar if d.get('imei') in ubicacion_por_imei]
+                hilos = min(MAX_HILOS_MONITOREO, len(con_ubicacion)) or 1
+                with ThreadPoolExecutor(max_workers=hilos) as executor:
+                    futuros = {
+                        executor.submit(self.api.enviar_datos_a_endpoint, self.endpoint_url, ubicacion_por_imei[dispositivo.get('imei')], self.headers): dispositivo
+                        for dispositivo in con_ubicacion
+                    }
                     
-                    # Enviar datos
-                    if self.api.enviar_ubicacion_a_endpoint(imei, self.endpoint_url, self.headers):
-                        self.estadisticas['envios_exitosos'] += 1
-                        print(f"   ✅ {nombre} ({imei})")
-                    else:
-                        self.estadisticas['errores'] += 1
-                        print(f"   ❌ {nombre} ({imei})")
+                    for futuro in as_completed(futuros):
+                        dispositivo = futuros[futuro]
+                        imei = dispositivo.get('imei')
+                        nombre = dispositivo.get('deviceName', 'Sin nombre')
+                        
+                        try:
+                            enviado = futuro.result()
+                        except Exception as e:
+                            logger.warning("   ⚠️ Error con %s: %s", imei, e)
+                            enviado = False
+                        
+                        if enviado:
+                            self._registrar(envios=1, exitosos=1)
+                            logger.info("   ✅ %s (%s)", nombre, imei)
+                        else:
+                            self._registrar(envios=1, errores=1)
+                            logger.error("   ❌ %s (%s)", nombre, imei)
+                        
+                        if self._evento_detener.is_set():  # Verificar si se debe detener
+                            executor.shutdown(wait=False, cancel_futures=True)
+                            break
                 
                 # Mostrar estadísticas
-                if self.estadisticas['total_envios'] > 0:
-                    tasa_exito = (self.estadisticas['envios_exitosos'] / self.estadisticas['total_envios']) * 100
-                    print(f"📊 Estadísticas: {self.estadisticas['envios_exitosos']}/{self.estadisticas['total_envios']} exitosos ({tasa_exito:.1f}%)")
+                est = self.estadisticas
+                if est['total_envios'] > 0:
+                    tasa_exito = (est['envios_exitosos'] / est['total_envios']) * 100
+                    logger.info("📊 Estadísticas: %d/%d exitosos (%.1f%%)", est['envios_exitosos'], est['total_envios'], tasa_exito)
                 
                 # Esperar hasta el siguiente ciclo
-                if self.activo:
-                    print(f"⏳ Esperando {self.intervalo} segundos...\n")
-                    time.sleep(self.intervalo)
+                self._esperar_siguiente_ciclo()
                 
             except KeyboardInterrupt:
-                print("\n🛑 Deteniendo monitoreo...")
+                logger.info("\n🛑 Deteniendo monitoreo...")
                 self.detener()
                 break
             except Exception as e:
-                print(f"❌ Error en monitoreo: {str(e)}")
-                self.estadisticas['errores'] += 1
-                if self.activo:
-                    time.sleep(self.intervalo)
+                logger.error("❌ Error en monitoreo: %s", e)
+                self._registrar(errores=1)
+                self._esperar_siguiente_ciclo()
     
     def iniciar(self):
         """Inicia el monitoreo automático en un hilo separado"""
@@ -474,6 +897,7 @@ class MonitorAutomatico:
             return False
         
         self.activo = True
+        self._evento_detener.clear()
         self.hilo_monitor = threading.Thread(target=self._monitorear, daemon=True)
         self.hilo_monitor.start()
         return True
@@ -485,33 +909,47 @@ class MonitorAutomatico:
             return False
         
         self.activo = False
+        self._evento_detener.set()  # Corta la espera entre ciclos al instante
+        terminado = True
         if self.hilo_monitor and self.hilo_monitor.is_alive():
-            self.hilo_monitor.join(timeout=2)
+            # Puede estar a mitad de una consulta y luego de los envíos en paralelo,
+            # cada fase acotada por el plazo de una petición con todos sus reintentos
+            self.hilo_monitor.join(timeout=2 * PLAZO_MAX_PETICION)
+            terminado = not self.hilo_monitor.is_alive()
+            if not terminado:
+                logger.warning("⚠️ El hilo de monitoreo sigue terminando peticiones en curso tras %.0f s", 2 * PLAZO_MAX_PETICION)
         
         # Mostrar estadísticas finales
-        if self.estadisticas['inicio']:
-            duracion = datetime.now() - self.estadisticas['inicio']
+        est = self.estadisticas
+        if est['inicio']:
+            duracion = datetime.now() - est['inicio']
             print(f"\n📊 ESTADÍSTICAS FINALES:")
             print(f"   Duración: {duracion}")
-            print(f"   Total envíos: {self.estadisticas['total_envios']}")
-            print(f"   Exitosos: {self.estadisticas['envios_exitosos']}")
-            print(f"   Errores: {self.estadisticas['errores']}")
-            if self.estadisticas['total_envios'] > 0:
-                tasa_exito = (self.estadisticas['envios_exitosos'] / self.estadisticas['total_envios']) * 100
+            print(f"   Total envíos: {est['total_envios']}")
+            print(f"   Exitosos: {est['envios_exitosos']}")
+            print(f"   Errores: {est['errores']}")
+            if est['ciclos_atrasados']:
+                print(f"   Ciclos más largos que el intervalo: {est['ciclos_atrasados']}")
+            if est['total_envios'] > 0:
+                tasa_exito = (est['envios_exitosos'] / est['total_envios']) * 100
                 print(f"   Tasa de éxito: {tasa_exito:.1f}%")
         
-        print("✅ Monitoreo detenido")
+        if terminado:
+            print("✅ Monitoreo detenido")
+        else:
+            print("⏳ Monitoreo detenido: los últimos envíos terminan en segundo plano")
         return True
     
     def estado(self):
         """Muestra el estado actual del monitoreo"""
         if self.activo:
-            duracion = datetime.now() - self.estadisticas['inicio'] if self.estadisticas['inicio'] else "N/A"
+            est = self.estadisticas
+            duracion = datetime.now() - est['inicio'] if est['inicio'] else "N/A"
             print(f"\n🟢 MONITOREO ACTIVO")
             print(f"   Intervalo: {self.intervalo} segundos")
             print(f"   Endpoint: {self.endpoint_url}")
             print(f"   Duración: {duracion}")
-            print(f"   Envíos: {self.estadisticas['envios_exitosos']}/{self.estadisticas['total_envios']}")
+            print(f"   Envíos: {est['envios_exitosos']}/{est['total_envios']}")
         else:
             print("\n🔴 MONITOREO INACTIVO")
 
@@ -628,12 +1066,16 @@ def mostrar_dispositivos(dispositivos: List[dict]):
     print("DISPOSITIVOS DISPONIBLES")
     print("="*80)
     
+    # Se arma el listado completo y se escribe de una vez
+    lineas = []
     for i, disp in enumerate(dispositivos, 1):
-        print(f"\n{i}. {disp.get('deviceName', 'Sin nombre')}")
-        print(f"   IMEI: {disp.get('imei')}")
-        print(f"   Modelo: {disp.get('mcType')}")
-        print(f"   Número de placa: {disp.get('vehicleNumber', 'N/A')}")
-        print(f"   Estado: {'Activo' if disp.get('enabledFlag') == 1 else 'Inactivo'}")
+        lineas.append(f"\n{i}. {disp.get('deviceName', 'Sin nombre')}")
+        lineas.append(f"   IMEI: {disp.get('imei')}")
+        lineas.append(f"   Modelo: {disp.get('mcType')}")
+        lineas.append(f"   Número de placa: {disp.get('vehicleNumber', 'N/A')}")
+        lineas.append(f"   Estado: {'Activo' if disp.get('enabledFlag') == 1 else 'Inactivo'}")
+    if lineas:
+        sys.stdout.write("\n".join(lineas) + "\n")
 
 
 def mostrar_ubicacion(ubicacion: dict):
@@ -664,8 +1106,9 @@ def mostrar_ubicacion(ubicacion: dict):
 
 def guardar_a_json(datos: dict, nombre_archivo: str):
     """Guarda los datos en un archivo JSON"""
-    with open(nombre_archivo, 'w', encoding='utf-8') as f:
-        json.dump(datos, f, indent=2, ensure_ascii=False)
+    # orjson escribe UTF-8 sin escapar (como ensure_ascii=False) directamente en bytes
+    with open(nombre_archivo, 'wb') as f:
+        f.write(orjson.dumps(datos, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE))
     print(f"\n💾 Datos guardados en: {nombre_archivo}")
 
 
@@ -678,42 +1121,245 @@ def guardar_a_csv(puntos_ruta: List[dict], nombre_archivo: str):
         return
     
     with open(nombre_archivo, 'w', newline='', encoding='utf-8') as f:
-        # Obtener todas las claves únicas
-        campos = set()
+        # Obtener todas las claves únicas en una sola pasada, en el orden en
+        # que aparecen (el de la API: coordenadas primero), sin ordenar
+        campos = {}
         for punto in puntos_ruta:
-            campos.update(punto.keys())
+            campos.update(dict.fromkeys(punto))
         
-        writer = csv.DictWriter(f, fieldnames=sorted(campos))
-        writer.writeheader()
-        writer.writerows(puntos_ruta)
+        # csv.writer con filas ya armadas: evita la validación por fila de DictWriter
+        campos = list(campos)
+        writer = csv.writer(f)
+        writer.writerow(campos)
+        writer.writerows([punto.get(campo, '') for campo in campos] for punto in puntos_ruta)
     
     print(f"\n💾 Ruta guardada en: {nombre_archivo}")
 
 
+# =============================================================================
+# OPCIONES DEL MENÚ
+# =============================================================================
+# Cada opción recibe el contexto de la sesión:
+# {'api', 'dispositivos', 'monitor', 'ultimo_endpoint'}
+# y devuelve True solo si el programa debe terminar
+
+def opcion_ver_ubicacion(ctx: dict):
+    """Opción 1: ubicación actual de un dispositivo"""
+    imei = input("\nIngresa el IMEI del dispositivo: ")
+    ubicacion = ctx['api'].obtener_ubicacion(imei, forzar=True)  # Se pidió la ubicación actual
+    if ubicacion:
+        mostrar_ubicacion(ubicacion)
+
+
+def opcion_historial_ruta(ctx: dict):
+    """Opción 2: historial de ruta, con opción de guardarlo en CSV"""
+    imei = input("\nIngresa el IMEI del dispositivo: ")
+    print("\nFormato de fecha: YYYY-MM-DD HH:MM:SS")
+    print("Ejemplo: 2025-01-13 08:00:00")
+    fecha_inicio = input("Fecha inicio: ")
+    fecha_fin = input("Fecha fin: ")
+    
+    ruta = ctx['api'].obtener_historial_ruta(imei, fecha_inicio, fecha_fin)
+    if ruta:
+        print(f"\n✅ Se encontraron {len(ruta)} puntos")
+        print("\nPrimeros 3 puntos:")
+        for i, punto in enumerate(islice(ruta, 3), 1):
+            print(f"\n{i}. Lat: {punto.get('lat')}, Lng: {punto.get('lng')}")
+            print(f"   Velocidad: {punto.get('gpsSpeed')} km/h")
+            print(f"   Fecha: {punto.get('gpsTime')}")
+        
+        guardar = input("\n¿Guardar toda la ruta en CSV? (s/n): ")
+        if guardar.lower() == 's':
+            guardar_a_csv(ruta, f"ruta_{imei}.csv")
+
+
+def opcion_guardar_json(ctx: dict):
+    """Opción 3: guardar la ubicación de un dispositivo en JSON"""
+    imei = input("\nIngresa el IMEI del dispositivo: ")
+    ubicacion = ctx['api'].obtener_ubicacion(imei)
+    if ubicacion:
+        guardar_a_json(ubicacion, f"ubicacion_{imei}.json")
+
+
+def seleccionar_endpoint(ctx: dict) -> Optional[tuple]:
+    """
+    Pregunta a qué endpoint enviar y con qué headers
+    
+    La última selección queda en el contexto de la sesión: en los siguientes
+    envíos basta con confirmarla.
+    
+    Args:
+        ctx: Contexto de la sesión del menú
+    
+    Returns:
+        Tupla (url, headers o None), o None si el endpoint predefinido no existe
+    """
+    ultimo = ctx.get('ultimo_endpoint')
+    if ultimo and input(f"\n¿Usar el último endpoint ({ultimo[0]})? (s/n): ").lower() == 's':
+        return ultimo
+    
+    # Mostrar endpoints predefinidos
+    print("\n¿Usar endpoint predefinido?")
+    listar_endpoints()
+    
+    usar_predefinido = input("\n¿Usar endpoint predefinido? (s/n): ")
+    
+    if usar_predefinido.lower() == 's':
+        nombre_endpoint = input("Nombre del endpoint: ")
+        config = obtener_endpoint(nombre_endpoint)
+        
+        if not config:
+            print("❌ Endpoint no encontrado")
+            return None
+        
+        endpoint_url = config['url']
+        headers = config['headers']
+        print(f"✅ Usando endpoint: {config['descripcion']}")
+    else:
+        endpoint_url = input("\nIngresa la URL del endpoint: ")
+        
+        # Opción para headers personalizados
+        usar_headers = input("¿Agregar headers personalizados? (s/n): ")
+        headers = None
+        if usar_headers.lower() == 's':
+            print("\nEjemplos de headers:")
+            print("Authorization: Bearer tu_token")
+            print("X-API-Key: tu_api_key")
+            print("Content-Type: application/json")
+            
+            headers = {}
+            while True:
+                header = input("\nHeader (formato 'clave: valor' o 'enter' para terminar): ")
+                if not header.strip():
+                    break
+                key, separador, value = header.partition(':')
+                if not separador:
+                    print("⚠️ Formato incorrecto. Usa 'clave: valor'")
+                    continue
+                headers[key.strip()] = value.strip()
+    
+    ctx['ultimo_endpoint'] = (endpoint_url, headers)
+    return ctx['ultimo_endpoint']
+
+
+def opcion_enviar_dispositivo(ctx: dict):
+    """Opción 4: enviar la ubicación de un dispositivo a un endpoint"""
+    imei = input("\nIngresa el IMEI del dispositivo: ")
+    
+    seleccion = seleccionar_endpoint(ctx)
+    if not seleccion:
+        return
+    
+    ctx['api'].enviar_ubicacion_a_endpoint(imei, *seleccion)
+
+
+def opcion_enviar_todos(ctx: dict):
+    """Opción 5: enviar las ubicaciones de todos los dispositivos a un endpoint"""
+    dispositivos = ctx['dispositivos']
+    
+    seleccion = seleccionar_endpoint(ctx)
+    if not seleccion:
+        return
+    endpoint_url, headers = seleccion
+    
+    # Un solo POST con todas las ubicaciones, si el endpoint lo admite
+    lote = input("¿El endpoint acepta todas las ubicaciones en un solo envío? (s/n): ").lower() == 's'
+    
+    print(f"\n📤 Enviando datos de {len(dispositivos)} dispositivos...")
+    
+    # Una consulta de ubicaciones para todos; envío en lote o en paralelo
+    resultados = ctx['api'].enviar_ubicaciones_a_endpoint([d.get('imei') for d in dispositivos], endpoint_url, headers, lote=lote)
+    lineas = []
+    for dispositivo in dispositivos:
+        imei = dispositivo.get('imei')
+        lineas.append(f"   {'✅' if resultados.get(imei) else '❌'} {dispositivo.get('deviceName')} ({imei})")
+    sys.stdout.write("\n".join(lineas) + "\n")
+    
+    exitosos = sum(resultados.values())
+    print(f"\n✅ Proceso completado: {exitosos}/{len(dispositivos)} dispositivos enviados")
+
+
+def opcion_configurar_monitoreo(ctx: dict):
+    """Opción 6: configurar el monitoreo automático"""
+    ctx['monitor'] = configurar_monitoreo_automatico(ctx['api'], ctx['dispositivos'])
+    if ctx['monitor']:
+        print("✅ Monitoreo configurado correctamente")
+    else:
+        print("❌ Error al configurar monitoreo")
+
+
+def opcion_iniciar_monitoreo(ctx: dict):
+    """Opción 7: iniciar el monitoreo automático"""
+    monitor = ctx['monitor']
+    if not monitor:
+        print("❌ Primero debes configurar el monitoreo (opción 6)")
+    else:
+        if monitor.iniciar():
+            print("🚀 Monitoreo iniciado")
+            print("💡 Tip: Usa la opción 9 para ver el estado")
+            print("⚠️ Para detener, usa la opción 8")
+
+
+def opcion_detener_monitoreo(ctx: dict):
+    """Opción 8: detener el monitoreo automático"""
+    if not ctx['monitor']:
+        print("❌ No hay monitoreo configurado")
+    else:
+        ctx['monitor'].detener()
+
+
+def opcion_estado_monitoreo(ctx: dict):
+    """Opción 9: estado del monitoreo automático"""
+    if not ctx['monitor']:
+        print("❌ No hay monitoreo configurado")
+    else:
+        ctx['monitor'].estado()
+
+
+def opcion_salir(ctx: dict):
+    """Opción 10: salir, deteniendo antes el monitoreo si está activo"""
+    monitor = ctx['monitor']
+    if monitor and monitor.activo:
+        print("🛑 Deteniendo monitoreo antes de salir...")
+        monitor.detener()
+    
+    # La sesión la comparten el menú y el monitor: se cierra al final
+    ctx['api'].cerrar()
+    
+    print("\n👋 ¡Hasta pronto!")
+    return True
+
+
+# Número de opción -> (texto del menú, manejador); el menú se imprime en este orden
+OPCIONES_MENU = {
+    "1": ("Ver ubicación actual de un dispositivo", opcion_ver_ubicacion),
+    "2": ("Ver historial de ruta de un dispositivo", opcion_historial_ruta),
+    "3": ("Guardar datos de ubicación en JSON", opcion_guardar_json),
+    "4": ("Enviar datos de ubicación a endpoint", opcion_enviar_dispositivo),
+    "5": ("Enviar datos de todos los dispositivos a endpoint", opcion_enviar_todos),
+    "6": ("🔄 Configurar monitoreo automático", opcion_configurar_monitoreo),
+    "7": ("🚀 Iniciar monitoreo automático", opcion_iniciar_monitoreo),
+    "8": ("🛑 Detener monitoreo automático", opcion_detener_monitoreo),
+    "9": ("📊 Estado del monitoreo", opcion_estado_monitoreo),
+    "10": ("Salir", opcion_salir),
+}
+
+
 # =============================================================================
 # PROGRAMA PRINCIPAL
 # =============================================================================
 
 def main():
     """Función principal del programa"""
+    configurar_logging(silencioso='--quiet' in sys.argv)
     
     print("="*80)
     print("EXTRACTOR DE DATOS GPS - TRACKSOLIDPRO")
     print("="*80)
     
-    # CONFIGURACIÓN desde variables de entorno
-    import os
-    from dotenv import load_dotenv
-    
-    load_dotenv()
-    
-    APP_KEY = os.getenv("TRACKSOLID_APP_KEY")
-    APP_SECRET = os.getenv("TRACKSOLID_APP_SECRET")
-    USER_EMAIL = os.getenv("TRACKSOLID_EMAIL")
-    USER_PASSWORD = os.getenv("TRACKSOLID_PASSWORD")
-    
-    # Verificar que todas las credenciales estén configuradas
-    if not all([APP_KEY, APP_SECRET, USER_EMAIL, USER_PASSWORD]):
+    # Verificar que todas las credenciales estén configuradas (CREDENCIALES
+    # se lee del entorno al importar el módulo)
+    if not CREDENCIALES.completas():
         print("\n❌ ERROR: Faltan credenciales en el archivo .env")
         print("Por favor, configura las siguientes variables en .env:")
         print("  - TRACKSOLID_APP_KEY")
@@ -723,7 +1369,7 @@ def main():
         return
     
     # Crear instancia de la API
-    api = TrackSolidAPI(APP_KEY, APP_SECRET, USER_EMAIL, USER_PASSWORD)
+    api = TrackSolidAPI(*astuple(CREDENCIALES))
     
     # Obtener token
     if not api.obtener_token():
@@ -739,191 +1385,28 @@ def main():
     
     mostrar_dispositivos(dispositivos)
     
-    # Crear instancia del monitor automático
-    monitor = None
+    # Contexto compartido por las opciones (el monitor lo crea la opción 6)
+    ctx = {'api': api, 'dispositivos': dispositivos, 'monitor': None, 'ultimo_endpoint': None}
+    
+    # El texto del menú no cambia entre vueltas: se arma una sola vez
+    menu = "\n".join(
+        ["\n" + "="*80, "MENÚ DE OPCIONES", "="*80]
+        + [f"{numero}. {texto}" for numero, (texto, _) in OPCIONES_MENU.items()]
+    )
     
     # Menú de opciones
     while True:
-        print("\n" + "="*80)
-        print("MENÚ DE OPCIONES")
-        print("="*80)
-        print("1. Ver ubicación actual de un dispositivo")
-        print("2. Ver historial de ruta de un dispositivo")
-        print("3. Guardar datos de ubicación en JSON")
-        print("4. Enviar datos de ubicación a endpoint")
-        print("5. Enviar datos de todos los dispositivos a endpoint")
-        print("6. 🔄 Configurar monitoreo automático")
-        print("7. 🚀 Iniciar monitoreo automático")
-        print("8. 🛑 Detener monitoreo automático")
-        print("9. 📊 Estado del monitoreo")
-        print("10. Salir")
-        
-        opcion = input("\nSelecciona una opción (1-10): ")
-        
-        if opcion == "1":
-            imei = input("\nIngresa el IMEI del dispositivo: ")
-            ubicacion = api.obtener_ubicacion(imei)
-            if ubicacion:
-                mostrar_ubicacion(ubicacion)
-        
-        elif opcion == "2":
-            imei = input("\nIngresa el IMEI del dispositivo: ")
-            print("\nFormato de fecha: YYYY-MM-DD HH:MM:SS")
-            print("Ejemplo: 2025-01-13 08:00:00")
-            fecha_inicio = input("Fecha inicio: ")
-            fecha_fin = input("Fecha fin: ")
-            
-            ruta = api.obtener_historial_ruta(imei, fecha_inicio, fecha_fin)
-            if ruta:
-                print(f"\n✅ Se encontraron {len(ruta)} puntos")
-                print("\nPrimeros 3 puntos:")
-                for i, punto in enumerate(ruta[:3], 1):
-                    print(f"\n{i}. Lat: {punto.get('lat')}, Lng: {punto.get('lng')}")
-                    print(f"   Velocidad: {punto.get('gpsSpeed')} km/h")
-                    print(f"   Fecha: {punto.get('gpsTime')}")
-                
-                guardar = input("\n¿Guardar toda la ruta en CSV? (s/n): ")
-                if guardar.lower() == 's':
-                    guardar_a_csv(ruta, f"ruta_{imei}.csv")
-        
-        elif opcion == "3":
-            imei = input("\nIngresa el IMEI del dispositivo: ")
-            ubicacion = api.obtener_ubicacion(imei)
-            if ubicacion:
-                guardar_a_json(ubicacion, f"ubicacion_{imei}.json")
-        
-        elif opcion == "4":
-            imei = input("\nIngresa el IMEI del dispositivo: ")
-            
-            # Mostrar endpoints predefinidos
-            print("\n¿Usar endpoint predefinido?")
-            listar_endpoints()
-            
-            usar_predefinido = input("\n¿Usar endpoint predefinido? (s/n): ")
-            
-            if usar_predefinido.lower() == 's':
-                nombre_endpoint = input("Nombre del endpoint: ")
-                config = obtener_endpoint(nombre_endpoint)
-                
-                if config:
-                    endpoint_url = config['url']
-                    headers = config['headers']
-                    print(f"✅ Usando endpoint: {config['descripcion']}")
-                else:
-                    print("❌ Endpoint no encontrado")
-                    continue
-            else:
-                endpoint_url = input("Ingresa la URL del endpoint: ")
-                
-                # Opción para headers personalizados
-                usar_headers = input("¿Agregar headers personalizados? (s/n): ")
-                headers = None
-                if usar_headers.lower() == 's':
-                    print("\nEjemplos de headers:")
-                    print("Authorization: Bearer tu_token")
-                    print("X-API-Key: tu_api_key")
-                    print("Content-Type: application/json")
-                    
-                    headers = {}
-                    while True:
-                        header = input("\nHeader (formato 'clave: valor' o 'enter' para terminar): ")
-                        if not header.strip():
-                            break
-                        try:
-                            key, value = header.split(':', 1)
-                            headers[key.strip()] = value.strip()
-                        except ValueError:
-                            print("⚠️ Formato incorrecto. Usa 'clave: valor'")
-            
-            api.enviar_ubicacion_a_endpoint(imei, endpoint_url, headers)
-        
-        elif opcion == "5":
-            # Mostrar endpoints predefinidos
-            print("\n¿Usar endpoint predefinido?")
-            listar_endpoints()
-            
-            usar_predefinido = input("\n¿Usar endpoint predefinido? (s/n): ")
-            
-            if usar_predefinido.lower() == 's':
-                nombre_endpoint = input("Nombre del endpoint: ")
-                config = obtener_endpoint(nombre_endpoint)
-                
-                if config:
-                    endpoint_url = config['url']
-                    headers = config['headers']
-                    print(f"✅ Usando endpoint: {config['descripcion']}")
-                else:
-                    print("❌ Endpoint no encontrado")
-                    continue
-            else:
-                endpoint_url = input("\nIngresa la URL del endpoint: ")
-                
-                # Opción para headers personalizados
-                usar_headers = input("¿Agregar headers personalizados? (s/n): ")
-                headers = None
-                if usar_headers.lower() == 's':
-                    headers = {}
-                    while True:
-                        header = input("\nHeader (formato 'clave: valor' o 'enter' para terminar): ")
-                        if not header.strip():
-                            break
-                        try:
-                            key, value = header.split(':', 1)
-                            headers[key.strip()] = value.strip()
-                        except ValueError:
-                            print("⚠️ Formato incorrecto. Usa 'clave: valor'")
-            
-            print(f"\n📤 Enviando datos de {len(dispositivos)} dispositivos...")
-            exitosos = 0
-            
-            for dispositivo in dispositivos:
-                imei = dispositivo.get('imei')
-                print(f"\n📱 Procesando {dispositivo.get('deviceName')} ({imei})")
-                
-                if api.enviar_ubicacion_a_endpoint(imei, endpoint_url, headers):
-                    exitosos += 1
-            
-            print(f"\n✅ Proceso completado: {exitosos}/{len(dispositivos)} dispositivos enviados")
+        print(menu)
         
-        elif opcion == "6":
-            monitor = configurar_monitoreo_automatico(api, dispositivos)
-            if monitor:
-                print("✅ Monitoreo configurado correctamente")
-            else:
-                print("❌ Error al configurar monitoreo")
+        opcion = input(f"\nSelecciona una opción (1-{len(OPCIONES_MENU)}): ")
         
-        elif opcion == "7":
-            if not monitor:
-                print("❌ Primero debes configurar el monitoreo (opción 6)")
-            else:
-                if monitor.iniciar():
-                    print("🚀 Monitoreo iniciado")
-                    print("💡 Tip: Usa la opción 9 para ver el estado")
-                    print("⚠️ Para detener, usa la opción 8")
-        
-        elif opcion == "8":
-            if not monitor:
-                print("❌ No hay monitoreo configurado")
-            else:
-                monitor.detener()
-        
-        elif opcion == "9":
-            if not monitor:
-                print("❌ No hay monitoreo configurado")
-            else:
-                monitor.estado()
+        entrada = OPCIONES_MENU.get(opcion)
+        if entrada is None:
+            print("\n⚠️ Opción no válida")
+            continue
         
-        elif opcion == "10":
-            # Detener monitoreo si está activo
-            if monitor and monitor.activo:
-                print("🛑 Deteniendo monitoreo antes de salir...")
-                monitor.detener()
-            
-            print("\n👋 ¡Hasta pronto!")
+        if entrada[1](ctx):
             break
-        
-        else:
-            print("\n⚠️ Opción no válida")
 
 
 if __name__ == "__main__":
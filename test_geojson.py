@@ -2,13 +2,18 @@
 Script para probar y guardar el GeoJSON generado
 """
 
+import os
 import requests
-import json
+import orjson
+import sys
 from datetime import datetime
 
 # URL del servidor (ajusta si es necesario)
 BASE_URL = "http://localhost:5000"
 
+# Formato del sello de tiempo en los nombres de archivo históricos
+TIMESTAMP_FMT = "%Y%m%d_%H%M%S"
+
 def obtener_geojson():
     """Obtiene el GeoJSON del servidor"""
     try:
@@ -16,7 +21,8 @@ def obtener_geojson():
         response = requests.get(f"{BASE_URL}/api/geojson")
         response.raise_for_status()
         
-        geojson = response.json()
+        # orjson parsea los bytes tal cual: sin decodificar antes el cuerpo a str
+        geojson = orjson.loads(response.content)
         
         print(f"✅ GeoJSON obtenido correctamente")
         print(f"   Total de dispositivos: {geojson.get('metadata', {}).get('total', 0)}")
@@ -26,39 +32,52 @@ def obtener_geojson():
     except requests.exceptions.RequestException as e:
         print(f"❌ Error: {str(e)}")
         return None
+    except orjson.JSONDecodeError as e:
+        print(f"❌ Respuesta no válida del servidor: {str(e)}")
+        return None
+
+def escribir_atomico(ruta, contenido):
+    """
+    Escribe bytes en un temporal y lo renombra sobre la ruta final
+    
+    Quien lea el archivo mientras se guarda ve la versión anterior completa,
+    nunca una a medio escribir (os.replace es atómico en el mismo sistema de archivos).
+    
+    Args:
+        ruta: Ruta final del archivo
+        contenido: Bytes a escribir
+    """
+    temporal = ruta + ".tmp"
+    with open(temporal, 'wb') as f:
+        f.write(contenido)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporal, ruta)
 
 def guardar_geojson(geojson, carpeta="geojson_publicos"):
     """Guarda el GeoJSON en un archivo"""
-    import os
-    
-    # Crear carpeta si no existe
-    if not os.path.exists(carpeta):
-        os.makedirs(carpeta)
+    # Crear carpeta si no existe (sin comprobar antes: exist_ok evita la carrera)
+    os.makedirs(carpeta, exist_ok=True)
     
     # Nombre del archivo con timestamp
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    timestamp = datetime.now().strftime(TIMESTAMP_FMT)
     nombre_archivo = f"{carpeta}/ubicaciones_{timestamp}.geojson"
     
-    # Guardar
-    with open(nombre_archivo, 'w', encoding='utf-8') as f:
-        json.dump(geojson, f, indent=2, ensure_ascii=False)
+    # Guardar (orjson escribe UTF-8 directamente, equivale a ensure_ascii=False)
+    escribir_atomico(nombre_archivo, orjson.dumps(geojson, option=orjson.OPT_INDENT_2 | orjson.OPT_APPEND_NEWLINE))
     
     print(f"💾 GeoJSON guardado en: {nombre_archivo}")
     return nombre_archivo
 
 def guardar_geojson_actual(geojson, carpeta="geojson_publicos"):
     """Guarda el GeoJSON con nombre fijo (siempre actualizado)"""
-    import os
-    
-    # Crear carpeta si no existe
-    if not os.path.exists(carpeta):
-        os.makedirs(carpeta)
+    # Crear carpeta si no existe (sin comprobar antes: exist_ok evita la carrera)
+    os.makedirs(carpeta, exist_ok=True)
     
     nombre_archivo = f"{carpeta}/ubicaciones_actual.geojson"
     
-    # Guardar
-    with open(nombre_archivo, 'w', encoding='utf-8') as f:
-        json.dump(geojson, f, indent=2, ensure_ascii=False)
+    # Guardar compacto: este archivo lo leen programas, no personas
+    escribir_atomico(nombre_archivo, orjson.dumps(geojson, option=orjson.OPT_APPEND_NEWLINE))
     
     print(f"💾 GeoJSON actual guardado en: {nombre_archivo}")
     return nombre_archivo
@@ -77,16 +96,18 @@ def mostrar_info_geojson(geojson):
     print(f"Generado: {metadata.get('generado', 'N/A')}")
     
     if features:
-        print(f"\nDispositivos:")
+        # Se arma el listado completo y se escribe de una vez
+        lineas = [f"\nDispositivos:"]
         for i, feature in enumerate(features, 1):
             props = feature.get('properties', {})
             coords = feature.get('geometry', {}).get('coordinates', [0, 0])
             
-            print(f"\n{i}. {props.get('deviceName', 'Sin nombre')}")
-            print(f"   IMEI: {props.get('imei')}")
-            print(f"   Coordenadas: {coords[1]}, {coords[0]}")
-            print(f"   Velocidad: {props.get('speed', 0)} km/h")
-            print(f"   Estado: {'Online' if props.get('status') == '1' else 'Offline'}")
+            lineas.append(f"\n{i}. {props.get('deviceName', 'Sin nombre')}")
+            lineas.append(f"   IMEI: {props.get('imei')}")
+            lineas.append(f"   Coordenadas: {coords[1]}, {coords[0]}")
+            lineas.append(f"   Velocidad: {props.get('speed', 0)} km/h")
+            lineas.append(f"   Estado: {'Online' if props.get('status') == '1' else 'Offline'}")
+        sys.stdout.write("\n".join(lineas) + "\n")
 
 if __name__ == "__main__":
     print("="*60)
@@ -2,30 +2,23 @@
 Script de prueba para verificar la conexión en Render
 """
 
-import os
-from dotenv import load_dotenv
-from main import TrackSolidAPI
+from dataclasses import astuple
+from main import CREDENCIALES, TrackSolidAPI, configurar_logging
+
+configurar_logging()
 
 print("="*80)
 print("TEST DE CONEXIÓN - RENDER")
 print("="*80)
 
-# Cargar variables de entorno
-load_dotenv()
-
-# Obtener credenciales
-APP_KEY = os.getenv("TRACKSOLID_APP_KEY")
-APP_SECRET = os.getenv("TRACKSOLID_APP_SECRET")
-USER_EMAIL = os.getenv("TRACKSOLID_EMAIL")
-USER_PASSWORD = os.getenv("TRACKSOLID_PASSWORD")
-
+# Credenciales leídas de .env / entorno por main al importarlo
 print("\n📋 VERIFICACIÓN DE VARIABLES DE ENTORNO:")
-print(f"   APP_KEY: {'✅ Configurado' if APP_KEY else '❌ NO configurado'}")
-print(f"   APP_SECRET: {'✅ Configurado' if APP_SECRET else '❌ NO configurado'}")
-print(f"   USER_EMAIL: {USER_EMAIL if USER_EMAIL else '❌ NO configurado'}")
-print(f"   USER_PASSWORD: {'✅ Configurado' if USER_PASSWORD else '❌ NO configurado'}")
+print(f"   APP_KEY: {'✅ Configurado' if CREDENCIALES.app_key else '❌ NO configurado'}")
+print(f"   APP_SECRET: {'✅ Configurado' if CREDENCIALES.app_secret else '❌ NO configurado'}")
+print(f"   USER_EMAIL: {CREDENCIALES.email if CREDENCIALES.email else '❌ NO configurado'}")
+print(f"   USER_PASSWORD: {'✅ Configurado' if CREDENCIALES.password else '❌ NO configurado'}")
 
-if not all([APP_KEY, APP_SECRET, USER_EMAIL, USER_PASSWORD]):
+if not CREDENCIALES.completas():
     print("\n❌ ERROR: Faltan credenciales")
     print("\nEn Render, configura las variables de entorno:")
     print("   Environment → Add Environment Variable")
@@ -38,7 +31,7 @@ if not all([APP_KEY, APP_SECRET, USER_EMAIL, USER_PASSWORD]):
 print("\n🔑 PROBANDO CONEXIÓN A LA API...")
 
 try:
-    api = TrackSolidAPI(APP_KEY, APP_SECRET, USER_EMAIL, USER_PASSWORD)
+    api = TrackSolidAPI(*astuple(CREDENCIALES))
     
     print("   Solicitando token...")
     if api.obtener_token():